@@ -0,0 +1,416 @@
+"""Measure the throughput and tail latency of a running checkface api.
+
+Either replays the GET requests of an access log, or generates a mix of face,
+morph frame, link preview and hashdata requests. Generated keys follow a Zipf
+distribution, like real traffic where a few hashes are very popular, and the
+share of requests for keys that were already generated is set with --hit-ratio.
+
+Alongside the latencies it scrapes the server's prometheus metrics for the
+queue depth over time, the size of the generator batches and the cache results.
+Start the server with GENERATOR_ENGINE=synthetic to benchmark without a GPU.
+"""
+
+import argparse
+import bisect
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+#----------------------------------------------------------------------------
+
+class ZipfKeys:
+    '''
+    Draws key indexes in [0, numKeys), key k with probability proportional to 1 / (k + 1) ** s
+    '''
+    def __init__(self, numKeys, s, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, numKeys + 1):
+            total += 1.0 / rank ** s
+            self.cumulative.append(total)
+
+    def draw(self):
+        i = bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return min(i, len(self.cumulative) - 1)
+
+def requestPath(kind, value, otherValue, dim, numFrames):
+    '''
+    The api path for a request of kind, about the key value and for morphs also otherValue
+    '''
+    if kind == 'face':
+        params = {'value': value, 'dim': dim}
+    elif kind == 'morphframe':
+        # the frame is part of the key, so a hit asks for the same frame again
+        frame = int(uuid.uuid5(uuid.NAMESPACE_OID, value).hex, 16) % numFrames
+        params = {'from_value': value, 'to_value': otherValue, 'num_frames': numFrames, 'frame_num': frame, 'dim': dim}
+    elif kind == 'linkpreview':
+        params = {'from_value': value, 'to_value': otherValue}
+    elif kind == 'hashdata':
+        params = {'value': value}
+    else:
+        raise ValueError(f"Unknown request kind {kind}")
+    return f"/api/{kind}/?{urllib.parse.urlencode(params)}"
+
+class MixWorkload:
+    '''
+    Generates requests of each kind in proportion to its weight. With probability hitRatio the key is
+    drawn from a fixed Zipfian keyspace that is generated during warm up, otherwise it has never been seen
+    '''
+    def __init__(self, mix, numKeys, zipfS, hitRatio, keyPrefix, dim, numFrames, seed):
+        self.rng = random.Random(seed)
+        self.kinds = list(mix)
+        self.cumulativeWeights = []
+        total = 0
+        for kind in self.kinds:
+            total += mix[kind]
+            self.cumulativeWeights.append(total)
+        self.keys = ZipfKeys(numKeys, zipfS, self.rng)
+        self.numKeys = numKeys
+        self.hitRatio = hitRatio
+        self.keyPrefix = keyPrefix
+        self.runId = uuid.uuid4().hex[:8]
+        self.dim = dim
+        self.numFrames = numFrames
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def keyPath(self, kind, k):
+        return requestPath(kind, f"{self.keyPrefix}-{k}", f"{self.keyPrefix}-{(k + 1) % self.numKeys}",
+                           self.dim, self.numFrames)
+
+    def warmupPaths(self):
+        '''
+        Every request the hits can make
+        '''
+        return [self.keyPath(kind, k) for k in range(self.numKeys) for kind in self.kinds]
+
+    def next(self):
+        with self.lock:
+            kind = self.kinds[bisect.bisect_right(self.cumulativeWeights, self.rng.random() * self.cumulativeWeights[-1])]
+            if self.rng.random() < self.hitRatio:
+                return kind, self.keyPath(kind, self.keys.draw())
+            self.misses += 1
+            missKey = f"{self.keyPrefix}-miss-{self.runId}-{self.misses}"
+            return kind, requestPath(kind, missKey, missKey + "-to", self.dim, self.numFrames)
+
+_logRequest = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+
+def requestKind(path):
+    '''
+    The kind of request for reporting, the first part of the path after /api/
+    '''
+    parts = urllib.parse.urlsplit(path).path.strip('/').split('/')
+    if len(parts) >= 2 and parts[0] == 'api':
+        return parts[1]
+    return parts[0] or 'index'
+
+class ReplayWorkload:
+    '''
+    Replays the GET requests of a common or combined format access log, such as nginx or werkzeug's, in order
+    '''
+    def __init__(self, lines):
+        self.paths = [m.group(1) for m in map(_logRequest.search, lines) if m]
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def warmupPaths(self):
+        return []
+
+    def next(self):
+        with self.lock:
+            if self.position >= len(self.paths):
+                return None
+            path = self.paths[self.position]
+            self.position += 1
+        return requestKind(path), path
+
+#----------------------------------------------------------------------------
+
+def scrapeMetrics(metricsUrl):
+    '''
+    Returns {(sample name, sorted labels): value} from a prometheus endpoint, or None if it can't be read
+    '''
+    try:
+        text = requests.get(metricsUrl, timeout=5).text
+    except requests.RequestException:
+        return None
+    samples = {}
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            samples[(sample[0], tuple(sorted(sample[1].items())))] = sample[2]
+    return samples
+
+def metricDelta(before, after, name):
+    '''
+    How much each labelled series of name grew between two scrapes
+    '''
+    return {labels: value - before.get((sampleName, labels), 0.0)
+            for (sampleName, labels), value in after.items() if sampleName == name}
+
+def batchSizeHistogram(before, after):
+    '''
+    Number of generator batches of each size bucket run during the benchmark, from the cumulative buckets
+    '''
+    buckets = sorted(((float(dict(labels)['le']), count) for labels, count in
+                      metricDelta(before, after, 'generator_batch_size_bucket').items()), key=lambda b: b[0])
+    histogram = []
+    previous = 0.0
+    for le, count in buckets:
+        histogram.append(('+Inf' if le == float('inf') else f"<={le:g}", int(round(count - previous))))
+        previous = count
+    return histogram
+
+def percentile(sortedValues, p):
+    if not sortedValues:
+        return float('nan')
+    return sortedValues[min(len(sortedValues) - 1, int(p / 100.0 * len(sortedValues)))]
+
+#----------------------------------------------------------------------------
+
+class Benchmark:
+    def __init__(self, url, workload, concurrency, timeout):
+        self.url = url.rstrip('/')
+        self.workload = workload
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.results = [] # (kind, start, seconds, status)
+        self.lock = threading.Lock()
+
+    def _fetch(self, session, path):
+        start = time.time()
+        try:
+            response = session.get(self.url + path, timeout=self.timeout)
+            response.content
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        return start, time.time() - start, status
+
+    def warmup(self):
+        paths = self.workload.warmupPaths()
+        if not paths:
+            return
+        print(f"Warming up {len(paths)} requests...")
+        pending = list(paths)
+        lock = threading.Lock()
+
+        def run():
+            session = requests.Session()
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    path = pending.pop()
+                self._fetch(session, path)
+        self._runThreads(run)
+
+    def _runThreads(self, target):
+        threads = [threading.Thread(target=target, daemon=True) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run(self, durationSeconds, maxRequests):
+        deadline = time.time() + durationSeconds if durationSeconds else None
+        counter = [0]
+
+        def run():
+            session = requests.Session()
+            while deadline is None or time.time() < deadline:
+                with self.lock:
+                    if maxRequests and counter[0] >= maxRequests:
+                        return
+                    counter[0] += 1
+                request = self.workload.next()
+                if request is None:
+                    return
+                kind, path = request
+                start, seconds, status = self._fetch(session, path)
+                with self.lock:
+                    self.results.append((kind, start, seconds, status))
+        self._runThreads(run)
+
+class QueuePoller:
+    '''
+    Samples the job_queue gauge of the server in the background
+    '''
+    def __init__(self, metricsUrl, intervalSeconds):
+        self.metricsUrl = metricsUrl
+        self.intervalSeconds = intervalSeconds
+        self.samples = [] # (time, depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+
+    def _poll(self):
+        while not self.stopped.is_set():
+            metrics = scrapeMetrics(self.metricsUrl)
+            if metrics is not None:
+                self.samples.append((time.time(), metrics.get(('job_queue', ()), 0.0)))
+            self.stopped.wait(self.intervalSeconds)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+#----------------------------------------------------------------------------
+
+def summarize(results, startTime, endTime, queueSamples, metricsBefore, metricsAfter):
+    elapsed = max(endTime - startTime, 1e-9)
+    report = {'elapsed_seconds': elapsed, 'requests': len(results), 'kinds': {}}
+    for kind in sorted(set(r[0] for r in results)) + ['all']:
+        kindResults = [r for r in results if kind == 'all' or r[0] == kind]
+        latencies = sorted(r[2] for r in kindResults if r[3] == 200)
+        report['kinds'][kind] = {
+            'requests': len(kindResults),
+            'errors': sum(1 for r in kindResults if r[3] != 200),
+            'throughput_rps': len(kindResults) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+    report['queue_depth'] = [(t - startTime, depth) for t, depth in queueSamples]
+    if metricsBefore is not None and metricsAfter is not None:
+        report['batch_sizes'] = batchSizeHistogram(metricsBefore, metricsAfter)
+        cacheResults = {}
+        for labels, count in metricDelta(metricsBefore, metricsAfter, 'media_cache_results_total').items():
+            result = dict(labels)['result']
+            cacheResults[result] = cacheResults.get(result, 0) + int(round(count))
+        report['cache_results'] = cacheResults
+    return report
+
+def printReport(report):
+    print(f"\n{report['requests']} requests in {report['elapsed_seconds']:.1f}s\n")
+    print(f"{'kind':<14}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, stats in report['kinds'].items():
+        print(f"{kind:<14}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+    if report['queue_depth']:
+        depths = [depth for _, depth in report['queue_depth']]
+        print(f"\nQueue depth: mean {sum(depths) / len(depths):.1f}, max {max(depths):.0f}")
+        # about 20 evenly spaced samples over the run
+        step = max(1, len(report['queue_depth']) // 20)
+        for t, depth in report['queue_depth'][::step]:
+            print(f"  {t:7.1f}s {depth:5.0f} {'#' * int(min(depth, 60))}")
+
+    if 'batch_sizes' in report:
+        batches = sum(count for _, count in report['batch_sizes'])
+        print(f"\nGenerator batches: {batches}")
+        for bucket, count in report['batch_sizes']:
+            if count:
+                print(f"  {bucket:>6} {count:6d} {'#' * int(60 * count / batches)}")
+        cacheResults = report['cache_results']
+        total = sum(cacheResults.values())
+        if total:
+            served = total - cacheResults.get('miss', 0)
+            print(f"\nMedia cache: {served / total:.1%} hits " +
+                  ", ".join(f"{result} {count}" for result, count in sorted(cacheResults.items())))
+    else:
+        print("\nCouldn't read the server metrics, batch sizes and cache results are not available")
+
+#----------------------------------------------------------------------------
+
+_examples = '''examples:
+
+  # Start a server that needs no GPU, then run the default mix against it for a minute
+  GENERATOR_ENGINE=synthetic python checkface.py
+  python %(prog)s --duration=60 --concurrency=16
+
+  # Mostly faces of a few popular hashes, with 90%% of requests for ones already generated
+  python %(prog)s --mix=face=90,hashdata=10 --keys=50 --zipf-s=1.2 --hit-ratio=0.9
+
+  # Replay production traffic
+  python %(prog)s --replay=access.log --concurrency=32 --json=results.json
+'''
+
+def parseMix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        weights[kind.strip()] = float(weight)
+    return weights
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the throughput and latency of a checkface api with generated or replayed traffic.',
+        epilog=_examples,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--url', help='Api to benchmark (default: %(default)s)', default='http://localhost:8080')
+    parser.add_argument('--metrics-url', help='Prometheus metrics of the same server (default: %(default)s)',
+                        default='http://localhost:8000/metrics')
+    parser.add_argument('--duration', help='Seconds to run for (default: %(default)s)', type=float, default=30)
+    parser.add_argument('--requests', help='Stop after this many requests instead', type=int)
+    parser.add_argument('--concurrency', help='Requests in flight at once (default: %(default)s)', type=int, default=8)
+    parser.add_argument('--timeout', help='Seconds before a request counts as an error (default: %(default)s)',
+                        type=float, default=60)
+    parser.add_argument('--replay', help='Replay the GET requests of this access log instead of generating them')
+    parser.add_argument('--mix', help='Weights of each request kind (default: %(default)s)',
+                        default='face=70,morphframe=15,linkpreview=5,hashdata=10')
+    parser.add_argument('--keys', help='Number of distinct keys hits are drawn from (default: %(default)s)',
+                        type=int, default=200)
+    parser.add_argument('--zipf-s', help='Zipf exponent of key popularity, 0 is uniform (default: %(default)s)',
+                        type=float, default=1.0)
+    parser.add_argument('--hit-ratio', help='Share of requests for keys that were already generated (default: %(default)s)',
+                        type=float, default=0.8)
+    parser.add_argument('--no-warmup', help="Don't request every key before measuring, so early hits are misses",
+                        action='store_true')
+    parser.add_argument('--key-prefix', help='Prefix of generated keys, change it to start from a cold cache (default: %(default)s)',
+                        default='bench')
+    parser.add_argument('--dim', help='Image dim of faces and morph frames (default: %(default)s)', type=int, default=300)
+    parser.add_argument('--num-frames', help='Frames in each morph (default: %(default)s)', type=int, default=25)
+    parser.add_argument('--seed', help='Random seed, for repeatable request sequences (default: %(default)s)',
+                        type=int, default=0)
+    parser.add_argument('--poll-interval', help='Seconds between queue depth samples (default: %(default)s)',
+                        type=float, default=0.5)
+    parser.add_argument('--json', help='Also write the full report to this file')
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f:
+            workload = ReplayWorkload(f.readlines())
+        print(f"Replaying {len(workload.paths)} requests")
+    else:
+        workload = MixWorkload(parseMix(args.mix), args.keys, args.zipf_s, args.hit_ratio,
+                               args.key_prefix, args.dim, args.num_frames, args.seed)
+
+    benchmark = Benchmark(args.url, workload, args.concurrency, args.timeout)
+    if not args.no_warmup:
+        benchmark.warmup()
+
+    metricsBefore = scrapeMetrics(args.metrics_url)
+    poller = QueuePoller(args.metrics_url, args.poll_interval)
+    poller.start()
+    startTime = time.time()
+    benchmark.run(None if args.requests else args.duration, args.requests)
+    endTime = time.time()
+    poller.stop()
+    metricsAfter = scrapeMetrics(args.metrics_url)
+
+    report = summarize(benchmark.results, startTime, endTime, poller.samples, metricsBefore, metricsAfter)
+    printReport(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not report['requests'] or report['kinds']['all']['errors'] == report['requests']:
+        sys.exit(1)
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,339 @@
+"""Keep the generated media in storage within a byte budget per category.
+
+Accesses are buffered in memory and written to a small sqlite index of every
+stored file's size, last access time and hit count. Collection runs in small
+steps, each scanning a bounded number of stored files into the index and then
+deleting the coldest entries of any category over its budget, so it never
+needs a long walk of the whole tree while requests are waiting.
+
+Used as a background thread by checkface.py, or run on its own to clean up
+checkfacedata from cron.
+"""
+
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from storage import storageFromEnv
+from packstore import PackDirLocked
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------
+
+CATEGORIES = ('faces', 'frames', 'videos', 'previews')
+
+# the top level dirs of storage that are managed, as laid out by checkface.py
+scanPrefixes = ('outputImages', 'masterImages', 'outputSprites', 'outputMorphs')
+
+_facesPattern = re.compile(r'^(outputImages|masterImages|outputSprites)/')
+# frames are grouped with the videos made from them, by morph dir, frame count and dim.
+# videos are only made from trig frames
+_framesPattern = re.compile(r'^(outputMorphs/.+)/frames/(trig|linear) n(\d+)x(\d+)/[^/]+$')
+_videosPattern = re.compile(r'^(outputMorphs/.+)/(GIFs|mp4s|webPs)/n(\d+)f\d+x(\d+)(k\d+)?\.\w+$')
+_previewsPattern = re.compile(r'^outputMorphs/.+/(linkPreviews/[^/]+|FROM\.jpg|TO\.jpg)$')
+
+def categorize(key):
+    '''
+    Returns (category, morph) for a storage key, morph links frames to the videos made from them.
+    category is None for keys that aren't managed
+    '''
+    if _facesPattern.match(key):
+        return 'faces', None
+    match = _framesPattern.match(key)
+    if match:
+        parentDir, shape, numFrames, dim = match.groups()
+        return 'frames', f"{parentDir}/n{numFrames}x{dim}" if shape == 'trig' else None
+    match = _videosPattern.match(key)
+    if match:
+        parentDir, _, numFrames, dim, _ = match.groups()
+        return 'videos', f"{parentDir}/n{numFrames}x{dim}"
+    if _previewsPattern.match(key):
+        return 'previews', None
+    return None, None
+
+#----------------------------------------------------------------------------
+
+# every hit counts as this much more recent, up to _maxCountedHits hits,
+# so popular entries outlive ones that were only seen once
+_hitBonusSeconds = 3600
+_maxCountedHits = 16
+
+_schema = f'''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    morph TEXT,
+    size INTEGER NOT NULL,
+    lastAccess REAL NOT NULL,
+    hits INTEGER NOT NULL,
+    seen INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entriesByScore ON entries (category, lastAccess + {_hitBonusSeconds} * min(hits, {_maxCountedHits}));
+CREATE INDEX IF NOT EXISTS entriesByMorph ON entries (morph);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value
+);
+'''
+
+class CacheCollector:
+    '''
+    Deletes the least valuable files of each category in budgets (bytes) once it is over budget.
+
+    Frames of morphs that already have a GIF, MP4 or WebP are deleted before any
+    others, as they are only needed again if another format or fps is asked for.
+    Nothing accessed in the last minAgeSeconds is deleted, so frames are never
+    removed from under an ffmpeg run that is about to use them.
+
+    deletedBytesCounter is an optional prometheus counter with a category label
+    '''
+
+    def __init__(self, storage, dbPath, budgets, minAgeSeconds=600, scanBatch=1000, deleteBatch=200,
+                 rescanSeconds=24 * 60 * 60, deletedBytesCounter=None):
+        self.storage = storage
+        self.budgets = dict(budgets)
+        self.minAgeSeconds = minAgeSeconds
+        self.scanBatch = scanBatch
+        self.deleteBatch = deleteBatch
+        self.rescanSeconds = rescanSeconds
+        self.deletedBytesCounter = deletedBytesCounter
+        self.pending = {}
+        self.pendingLock = threading.Lock()
+        self.stepLock = threading.Lock()
+        self.scanner = None
+
+        if os.path.dirname(dbPath):
+            os.makedirs(os.path.dirname(dbPath), exist_ok=True)
+        self.db = sqlite3.connect(dbPath, check_same_thread=False, timeout=30)
+        self.db.executescript(_schema)
+
+    def touch(self, key, size=None):
+        '''
+        Records an access of key, or a write of size bytes to it. Cheap enough to call on every request
+        '''
+        now = time.time()
+        with self.pendingLock:
+            hits, oldSize, _ = self.pending.get(key, (0, None, None))
+            self.pending[key] = (hits + 1, size if size is not None else oldSize, now)
+
+    def _getState(self, name, default):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def _setState(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, value))
+
+    def flush(self):
+        with self.pendingLock:
+            pending, self.pending = self.pending, {}
+        seen = self._getState('scan', 0)
+        with self.db:
+            for key, (hits, size, lastAccess) in pending.items():
+                category, morph = categorize(key)
+                if category is None:
+                    continue
+                updated = self.db.execute(
+                    'UPDATE entries SET hits = hits + ?, size = coalesce(?, size), lastAccess = max(lastAccess, ?) WHERE key = ?',
+                    (hits, size, lastAccess, key)).rowcount
+                if not updated and size is not None:
+                    self.db.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (key, category, morph, size, lastAccess, hits, seen))
+
+    def _scanAll(self):
+        for prefix in scanPrefixes:
+            yield from self.storage.scan(prefix)
+
+    def scanStep(self):
+        '''
+        Indexes up to scanBatch more stored files, starting a new scan every rescanSeconds.
+        Returns True while a scan is in progress
+        '''
+        now = time.time()
+        if self.scanner is None:
+            if now - self._getState('scanFinished', 0) < self.rescanSeconds:
+                return False
+            with self.db:
+                self._setState('scan', self._getState('scan', 0) + 1)
+                self._setState('scanStarted', now)
+            self.scanner = self._scanAll()
+
+        scan = self._getState('scan', 0)
+        batch = []
+        for key, size, mtime in self.scanner:
+            category, morph = categorize(key)
+            if category is not None:
+                batch.append((key, category, morph, size, min(mtime, now)))
+                if len(batch) >= self.scanBatch:
+                    break
+        with self.db:
+            # files already indexed keep their access history, new ones count as last accessed when they were written
+            self.db.executemany('UPDATE entries SET size = ?, seen = ? WHERE key = ?',
+                                [(size, scan, key) for key, _, _, size, _ in batch])
+            self.db.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, 0, ?)',
+                                [(key, category, morph, size, mtime, scan) for key, category, morph, size, mtime in batch])
+        if len(batch) >= self.scanBatch:
+            return True
+
+        self.scanner = None
+        with self.db:
+            # forget files that have gone from storage, unless they were written during the scan
+            self.db.execute('DELETE FROM entries WHERE seen < ? AND lastAccess < ?', (scan, self._getState('scanStarted', 0)))
+            self._setState('scanFinished', now)
+        return False
+
+    def usage(self):
+        '''
+        Returns the indexed bytes of each category
+        '''
+        usage = {category: 0 for category in CATEGORIES}
+        for category, total in self.db.execute('SELECT category, sum(size) FROM entries GROUP BY category'):
+            usage[category] = total
+        return usage
+
+    def victims(self, category, bytesToFree, maxCount=None):
+        '''
+        Returns [(key, size)] of the entries to delete to free bytesToFree from category, coldest first
+        '''
+        firstFrames = '''EXISTS (SELECT 1 FROM entries AS videos
+                                 WHERE videos.morph = entries.morph AND videos.category = 'videos') DESC,''' \
+                      if category == 'frames' else ''
+        cursor = self.db.execute(f'''
+            SELECT key, size FROM entries
+            WHERE category = ? AND lastAccess < ?
+            ORDER BY {firstFrames} lastAccess + {_hitBonusSeconds} * min(hits, {_maxCountedHits})
+        ''', (category, time.time() - self.minAgeSeconds))
+        victims = []
+        for key, size in cursor:
+            if bytesToFree <= 0 or (maxCount is not None and len(victims) >= maxCount):
+                break
+            victims.append((key, size))
+            bytesToFree -= size
+        cursor.close()
+        return victims
+
+    def collectStep(self, maxCount=None):
+        '''
+        Deletes up to maxCount entries of each category over budget, returns [(key, size)] of what was deleted
+        '''
+        deleted = []
+        usage = self.usage()
+        for category, budget in self.budgets.items():
+            for key, size in self.victims(category, usage[category] - budget, maxCount):
+                self.storage.delete(key)
+                with self.db:
+                    self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                if self.deletedBytesCounter is not None:
+                    self.deletedBytesCounter.labels(category).inc(size)
+                deleted.append((key, size))
+        return deleted
+
+    def step(self):
+        '''
+        One bounded unit of work, returns True if there is more to do straight away
+        '''
+        with self.stepLock:
+            self.flush()
+            scanning = self.scanStep()
+            deleted = self.collectStep(self.deleteBatch)
+            return scanning or len(deleted) >= self.deleteBatch
+
+    def start(self, intervalSeconds):
+        threading.Thread(target=self._run, args=(intervalSeconds,), daemon=True).start()
+
+    def _run(self, intervalSeconds):
+        while True:
+            try:
+                moreWork = self.step()
+            except Exception:
+                logger.exception("Cache collection failed")
+                moreWork = False
+            # yield between steps even when busy, so request threads get the GIL and the disk
+            time.sleep(0.05 if moreWork else intervalSeconds)
+
+#----------------------------------------------------------------------------
+
+def budgetsFromEnv():
+    '''
+    Reads the CACHE_BUDGET_<CATEGORY>_MB environment variables, unset categories are unbounded
+    '''
+    budgets = {}
+    for category in CATEGORIES:
+        budgetMb = os.getenv(f'CACHE_BUDGET_{category.upper()}_MB')
+        if budgetMb:
+            budgets[category] = int(float(budgetMb) * 1024 * 1024)
+    return budgets
+
+def defaultDbPath():
+    return os.getenv('CACHE_INDEX_DB', os.path.join(os.getcwd(), "checkfacedata", "cacheIndex.sqlite3"))
+
+#----------------------------------------------------------------------------
+
+def formatMb(numBytes):
+    return f"{numBytes / 1024 / 1024:.1f} MB"
+
+_examples = '''examples:
+
+  # Use the same CACHE_BUDGET_*_MB variables as the server
+  CACHE_BUDGET_FRAMES_MB=2048 python %(prog)s
+
+  # See what would be deleted to get faces down to 10 GB
+  python %(prog)s --budget faces=10240 --dry-run
+'''
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='''Delete the least recently and least often used generated media until each category is within its budget.
+Run from the same working directory and with the same storage environment variables as checkface.py.''',
+        epilog=_examples,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--budget', help=f'category=MB, overriding CACHE_BUDGET_<CATEGORY>_MB, categories are {", ".join(CATEGORIES)}',
+                        action='append', default=[])
+    parser.add_argument('--db', help='Access index to use (default: %(default)s)', default=defaultDbPath())
+    parser.add_argument('--min-age', help='Never delete anything accessed in this many seconds (default: %(default)s)', type=float, default=600)
+    parser.add_argument('--dry-run', help='Only print what would be deleted', action='store_true')
+    args = parser.parse_args()
+
+    budgets = budgetsFromEnv()
+    for budget in args.budget:
+        category, budgetMb = budget.split('=')
+        if category not in CATEGORIES:
+            parser.error(f'Unknown category {category}')
+        budgets[category] = int(float(budgetMb) * 1024 * 1024)
+    if not budgets:
+        parser.error('No budgets set, use --budget or CACHE_BUDGET_<CATEGORY>_MB')
+
+    try:
+        storage = storageFromEnv(os.path.join(os.getcwd(), "checkfacedata"))
+    except PackDirLocked as e:
+        sys.exit(f'{e}. Set CACHE_BUDGET_<CATEGORY>_MB on the server to collect a pack dir while it is running.')
+    collector = CacheCollector(storage, args.db, budgets, minAgeSeconds=args.min_age, rescanSeconds=0)
+    collector.flush()
+    print('Indexing storage...')
+    while collector.scanStep():
+        pass
+    usage = collector.usage()
+    for category in CATEGORIES:
+        print(f'  {category:<10}{formatMb(usage[category]):>14} of {formatMb(budgets[category]) if category in budgets else "unbounded"}')
+
+    if args.dry_run:
+        for category, budget in budgets.items():
+            victims = collector.victims(category, usage[category] - budget)
+            print(f'Would delete {len(victims)} {category} files, {formatMb(sum(size for _, size in victims))}')
+        return
+
+    deleted = collector.collectStep()
+    print(f'Deleted {len(deleted)} files, {formatMb(sum(size for _, size in deleted))}')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,171 @@
+import threading
+import collections
+import random
+import hashlib
+import math
+
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+class FrequencySketch:
+    '''
+    Approximate access frequency counter (count-min sketch), which
+    periodically halves every count so that old popularity fades away
+    '''
+
+    def __init__(self, width=1 << 16, depth=4, sampleSize=None):
+        self.width = width
+        self.depth = depth
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.seeds = [random.getrandbits(32) for _ in range(depth)]
+        self.sampleSize = sampleSize or 10 * width
+        self.additions = 0
+
+    def _indexes(self, key):
+        for row, seed in zip(self.rows, self.seeds):
+            yield row, hash((seed, key)) % self.width
+
+    def increment(self, key):
+        for row, i in self._indexes(key):
+            if row[i] < 255:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sampleSize:
+            self._age()
+
+    def estimate(self, key):
+        return min(row[i] for row, i in self._indexes(key))
+
+    def _age(self):
+        for row in self.rows:
+            row[:] = row.translate(_HALVE)
+        self.additions //= 2
+
+
+class BloomFilter:
+    '''
+    Set membership in about 10 bits per key for a 1% false positive rate.
+    Never has false negatives, keys can't be removed
+    '''
+
+    def __init__(self, capacity, errorRate=0.01):
+        self.numBits = max(8, int(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.numHashes = max(1, round(self.numBits / capacity * math.log(2)))
+        self.bits = bytearray((self.numBits + 7) // 8)
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.numHashes):
+            yield (h1 + i * h2) % self.numBits
+
+    def add(self, key):
+        for i in self._indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+
+class ByteCache:
+    '''
+    Size bounded in memory cache of encoded images, keyed by output file name.
+
+    Uses a segmented LRU (new entries go on probation, entries hit again get
+    protected) with a TinyLFU style admission check: when full, a new entry
+    is only admitted if it has been asked for more often than the entry it
+    would evict, so a flood of one-off keys can't push out hot faces.
+
+    hitCounter, missCounter and evictionCounter are optional prometheus
+    counters, bytesGauge is an optional prometheus gauge
+    '''
+
+    def __init__(self, maxBytes, maxItemBytes=None, protectedRatio=0.8,
+                 hitCounter=None, missCounter=None, evictionCounter=None, bytesGauge=None):
+        self.maxBytes = maxBytes
+        # an item bigger than the whole cache would evict everything and still not fit
+        self.maxItemBytes = min(maxItemBytes or maxBytes, maxBytes)
+        self.maxProtectedBytes = int(maxBytes * protectedRatio)
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.protectedBytes = 0
+        self.totalBytes = 0
+        self.sketch = FrequencySketch()
+        self.lock = threading.Lock()
+        self.hitCounter = hitCounter
+        self.missCounter = missCounter
+        self.evictionCounter = evictionCounter
+        self.bytesGauge = bytesGauge
+
+    def __contains__(self, key):
+        return key in self.probation or key in self.protected
+
+    def get(self, key):
+        '''
+        Returns the cached (data, mimetype) or None
+        '''
+        with self.lock:
+            self.sketch.increment(key)
+            if key in self.protected:
+                self.protected.move_to_end(key)
+                entry = self.protected[key]
+            elif key in self.probation:
+                entry = self.probation.pop(key)
+                self.protected[key] = entry
+                self.protectedBytes += len(entry[0])
+                self._demoteProtected()
+            else:
+                entry = None
+
+        if entry is None:
+            self._inc(self.missCounter)
+        else:
+            self._inc(self.hitCounter)
+        return entry
+
+    def put(self, key, data, mimetype):
+        size = len(data)
+        if self.maxBytes <= 0 or size > self.maxItemBytes:
+            return False
+        with self.lock:
+            if key in self:
+                return True
+            while self.totalBytes + size > self.maxBytes:
+                victimKey = self._victim()
+                if self.sketch.estimate(key) <= self.sketch.estimate(victimKey):
+                    return False # not popular enough to displace anything
+                self._evict(victimKey)
+            self.probation[key] = (data, mimetype)
+            self.totalBytes += size
+        self._setBytesGauge()
+        return True
+
+    def _victim(self):
+        if self.probation:
+            return next(iter(self.probation))
+        return next(iter(self.protected))
+
+    def _evict(self, key):
+        if key in self.probation:
+            data, _ = self.probation.pop(key)
+        else:
+            data, _ = self.protected.pop(key)
+            self.protectedBytes -= len(data)
+        self.totalBytes -= len(data)
+        self._inc(self.evictionCounter)
+
+    def _demoteProtected(self):
+        while self.protectedBytes > self.maxProtectedBytes and len(self.protected) > 1:
+            key, entry = self.protected.popitem(last=False)
+            self.protectedBytes -= len(entry[0])
+            self.probation[key] = entry
+
+    def _setBytesGauge(self):
+        if self.bytesGauge is not None:
+            self.bytesGauge.set(self.totalBytes)
+
+    @staticmethod
+    def _inc(counter):
+        if counter is not None:
+            counter.inc()
@@ -6,8 +6,7 @@ import subprocess
 import shutil
 import base64
 import math
-import dnnlib.tflib as tflib
-import dnnlib
+from training import misc
 import time
 import os
 import PIL.Image
@@ -15,7 +14,14 @@ import PIL.ImageDraw
 import PIL
 import sys
 import tempfile
+import posixpath
+import io
+import zipfile
 import re
+import functools
+import contextlib
+import concurrent.futures
+import urllib.parse
 import pickle
 import numpy as np
 import queue
@@ -23,12 +29,41 @@ import hashlib
 from flask import send_file, request, jsonify, render_template
 import flask_cors
 from werkzeug.middleware.proxy_fix import ProxyFix
-from prometheus_client import start_http_server, Summary, Gauge, Counter
+from prometheus_client import start_http_server, Summary, Gauge, Counter, Histogram
 import pymongo
 import uuid
 import logging
 import requests
+from caches import ByteCache
+from scheduler import PriorityJobQueue
+from storage import storageFromEnv, indexFromEnv
+from cachegc import CacheCollector, budgetsFromEnv, defaultDbPath, scanPrefixes
+from tracing import tracerFromEnv, SpanContext, NOOP_SPAN
+from engines import engineFromEnv, engineNameFromEnv, startEngineProcesses
+from dlatents import DLatentCache
+from encoding import EncodePool, encoderSettingsFromEnv, resizeAndEncode
+from latentrecords import encodeLatent, decodeLatent, latentStorageDtypeFromEnv, recordProjection, GuidLatentCache
 np.set_printoptions(threshold=np.inf)
+
+# The generator and encode processes are forked, and a forked process only gets a copy of the thread that forked it,
+# with any locks the other threads held at the time stuck held. So they are started here, before the
+# mongo client's monitors, the storage index scan, the cache collector, pack compaction and the master writer
+# below start their threads.
+# 0 runs the generator on a thread of the server process, otherwise each of this many
+# processes runs its own replica, pulling batches from the same job queue
+generatorProcesses = int(os.getenv('GENERATOR_PROCESSES', '0'))
+remoteEngines = [None]
+if __name__ == "__main__" and generatorProcesses > 0:
+    engineSlots = int(os.getenv('GENERATOR_SHM_SLOTS', str(2 * int(os.getenv('GENERATOR_BATCH_SIZE', '10')))))
+    remoteEngines = startEngineProcesses(generatorProcesses, engineSlots)
+
+# 0 resizes and encodes on the request threads.
+# After the generator processes, as the pool runs threads of its own
+encodeProcesses = int(os.getenv('ENCODE_PROCESSES', '0'))
+encodePool = None
+if encodeProcesses > 0:
+    encodePool = EncodePool(encodeProcesses, int(os.getenv('ENCODE_SHM_SLOTS', str(2 * encodeProcesses))))
+
 mongodb_conn_str = os.getenv("MONGODB_CONNECTION_STRING", "mongodb://root:example@db")
 client = pymongo.MongoClient(mongodb_conn_str)
 db = client.test
@@ -38,17 +73,10 @@ sys.path.append('/app/dnnlib')
 # dnnlib.tflib.init_tf()
 
 
-def fetch_model():
-    network_pkl = 'gdrive:networks/stylegan2-ffhq-config-f.pkl'
-    import pretrained_networks
-    _G, _D, Gs = pretrained_networks.load_networks(network_pkl)
-    return Gs
 num_gpus = int(os.getenv('NUM_GPUS', '1'))
-synthesis_kwargs = dict(output_transform=dict(
-    func=tflib.convert_images_to_uint8, nchw_to_nhwc=True), minibatch_size=20, num_gpus=num_gpus)
 
 # We need to have access to this dimension to generate qlatents and we don't
-# want to have to access the massive Gs object outside of the worker thread,
+# want to have to access the generator engine outside of the worker thread,
 # thus we update here when we can.
 
 GsInputDim = 512 # updated in worker
@@ -60,39 +88,59 @@ def fromSeed(seed):
 dlatent_avg = ""
 
 
-def truncTrick(dlatents, psi=0.7, cutoff=8):
-    #   return (toDLat(lat) - dlatent_avg) * psi + avg
+@functools.lru_cache()
+def truncCoefs(psi, cutoff):
     layer_idx = np.arange(18)[np.newaxis, :, np.newaxis]
     ones = np.ones(layer_idx.shape, dtype=np.float32)
-    coefs = np.where(layer_idx < cutoff, psi * ones, ones)
-    dlatents = (dlatents - dlatent_avg) * coefs + dlatent_avg
+    return np.where(layer_idx < cutoff, psi * ones, ones)
+
+def truncTrick(dlatents, psi=0.7, cutoff=8):
+    #   return (toDLat(lat) - dlatent_avg) * psi + avg
+    # works on a whole batch at once, [N, 18, 512]
+    dlatents = (dlatents - dlatent_avg) * truncCoefs(psi, cutoff) + dlatent_avg
     return dlatents
 
 
-def toDLat(Gs, lat, useTruncTrick=True):
+def toDLats(engine, latents, useTruncTrick=True):
+    '''
+    Returns latents, a mix of Z and W latents, as an [N, 18, 512] array of W latents.
+    All of the Z latents are mapped in a single run of the mapping network
+    '''
+    latents = [np.asarray(lat) for lat in latents]
+    dlatents = np.empty((len(latents), 18, 512), dtype=np.float32)
+    qRows = [i for i, lat in enumerate(latents) if lat.shape[0] == 512]
+    for i, lat in enumerate(latents):
+        if lat.shape[0] != 512:
+            dlatents[i] = lat
+    if qRows:
+        mapped = engine.map(np.stack([latents[i] for i in qRows]))
+        dlatents[qRows] = truncTrick(mapped) if useTruncTrick else mapped
+    return dlatents
+
+def toDLat(engine, lat, useTruncTrick=True):
     lat = np.array(lat)
     if lat.shape[0] == 512:
-        lats = Gs.components.mapping.run(np.array([lat]), None)
-        if useTruncTrick:
-            lat = truncTrick(lats)[0]
-        else:
-            lat = lats[0]
+        lat = toDLats(engine, [lat], useTruncTrick)[0]
     return lat
 
 
-def chooseQorDLat(Gs, latent1, latent2):
+def chooseQorDLat(engine, latent1, latent2):
     latent1 = np.array(latent1)
     latent2 = np.array(latent2)
     if(latent1.shape[0] == 18 and latent2.shape[0] == 512):
-        latent2 = toDLat(Gs, latent2)
+        latent2 = toDLat(engine, latent2)
 
     if(latent1.shape[0] == 512 and latent2.shape[0] == 18):
-        latent1 = toDLat(Gs, latent1)
+        latent1 = toDLat(engine, latent1)
 
     return latent1, latent2
 
 
-def toImages(Gs, latents, image_size):
+def toImages(engine, latents, image_size, timings=None):
+    '''
+    Seconds spent in the synthesis, convert and resize stages are added to timings if given
+    '''
+    timings = {} if timings is None else timings
     app.logger.info(f"")
     app.logger.info(f"toImages() ----------------------------------------------")
     app.logger.info(f"")
@@ -106,25 +154,29 @@ def toImages(Gs, latents, image_size):
                     isDlat = True
                     break
             if isDlat:
-                latents = [toDLat(Gs, lat) for lat in latents]
+                latents = toDLats(engine, latents)
 
         latents = np.array(latents)
+        # the conversion to uint8 is part of the network, so it is timed with synthesis
         if latents.shape[1] == 512:
-            images = Gs.run(latents, None, **synthesis_kwargs)
+            images = engine.synthesize(truncTrick(engine.map(latents)))
             network = "generator network"
         else:
-            images = Gs.components.synthesis.run(
-                latents, randomize_noise=False, structure='linear',
-                **synthesis_kwargs)
+            images = engine.synthesize(latents)
             network = "synthesis component"
         diff = time.time() - start
+        timings['synthesis'] = timings.get('synthesis', 0) + diff
 
         app.logger.info(f"Took {diff:.2f} seconds to run {network} on {len(latents)} latents")
+        start = time.time()
         pilImages = [PIL.Image.fromarray(img, 'RGB') for img in images]
+        timings['convert'] = timings.get('convert', 0) + time.time() - start
         if image_size:
+            start = time.time()
             pilImages = [img.resize(
                 (image_size, image_size), PIL.Image.ANTIALIAS)
                 for img in pilImages]
+            timings['resize'] = timings.get('resize', 0) + time.time() - start
 
         return pilImages
 
@@ -134,22 +186,48 @@ class LatentProxy:
     Represents something that can become a latent, be it a seed or a guid in the database
     '''
 
-    def getLatent(self, Gs = None):
+    # whether the W latent of this, and of the latents in getLatentsToMap, are used often enough to be worth
+    # keeping in the dlatent cache, rather than only ever being made for one image like a morph frame's
+    cacheDLatent = True
+    cacheLatentsToMap = True
+
+    def getLatent(self, engine = None):
         raise NotImplementedError()
 
+    def getLatentsToMap(self):
+        '''
+        The Z latents this one needs as W latents to get its own latent, as {name: latent}, so those of a whole batch
+        can be mapped at once beforehand (or found in the dlatent cache) and handed back to setMappedLatents
+        '''
+        return {}
+
+    def setMappedLatents(self, dlatents):
+        pass
+
     def getName(self):
         raise NotImplementedError()
 
     def getShardPartitions(self):
         raise NotImplementedError()
 
+    def getGuidProxies(self):
+        '''
+        The LatentByGuids this one is made from, whose latents have to be loaded from the database
+        '''
+        return []
+
+
+# Proxies only work out their latents when getLatent is first called, which is only once a job
+# is queued for them, so requests for images that are already stored only need their names
 
 class LatentBySeed(LatentProxy):
     def __init__(self, seed: int):
         self.seed = seed
-        self.latent = fromSeed(self.seed)
+        self.latent = None
 
-    def getLatent(self, Gs = None):
+    def getLatent(self, engine = None):
+        if self.latent is None:
+            self.latent = fromSeed(self.seed)
         return self.latent
 
     def getName(self):
@@ -167,16 +245,16 @@ class LatentByTextValue(LatentProxy):
         if not textValue:
             textValue = ''
         self.textValue = textValue
-        h = hashlib.sha256(textValue.encode('utf-8'))
-        self.hashhex = h.hexdigest()
-
-        # https://stackoverflow.com/a/36756272
-        # seed is an array of uint32
-        seed = np.frombuffer(h.digest(), dtype='uint32')
-        self.latent = fromSeed(seed)
-
-
-    def getLatent(self, Gs = None):
+        self.digest = hashlib.sha256(textValue.encode('utf-8')).digest()
+        self.hashhex = self.digest.hex()
+        self.latent = None
+
+    def getLatent(self, engine = None):
+        if self.latent is None:
+            # https://stackoverflow.com/a/36756272
+            # seed is an array of uint32
+            seed = np.frombuffer(self.digest, dtype='uint32')
+            self.latent = fromSeed(seed)
         return self.latent
 
     def getName(self):
@@ -192,19 +270,16 @@ class LatentByTextValue(LatentProxy):
 class LatentByGuid(LatentProxy):
     def __init__(self, guid: uuid.UUID):
         self.guid = guid
-        record = db.latents.find_one({'_id': str(self.guid)})
-        if not record:
-            raise KeyError('Cannot find latent for guid')
-        latentType = record['type']
-        if latentType == 'qlatent':
-            self.latent = np.array(record['latent'])
-        else:
-            self.latent = np.array(record['latent'])
-            # raise NotImplementedError(f"Latent not implemented for type: {latentType}")
+        self.latent = None
 
-    def getLatent(self, Gs = None):
+    def getLatent(self, engine = None):
+        if self.latent is None:
+            loadGuidLatents([self])
         return self.latent
 
+    def getGuidProxies(self):
+        return [self]
+
     def getName(self):
         return f"GUID{str(self.guid)}"
 
@@ -213,6 +288,8 @@ class LatentByGuid(LatentProxy):
         return [  name[:6], name[6:8] ]
 
 class LatentByLerp(LatentProxy):
+    cacheDLatent = False # a morph frame
+
     def __init__(self, fromLat:LatentProxy, toLat:LatentProxy, p: float):
         self.fromLat = fromLat
         self.toLat = toLat
@@ -224,23 +301,45 @@ class LatentByLerp(LatentProxy):
     def getShardPartitions(self):
         return [ "LERPS" ]
 
-    def getLatent(self, Gs):
-        latent1 = np.array(self.fromLat.getLatent(Gs))
-        latent2 = np.array(self.toLat.getLatent(Gs))
+    def getGuidProxies(self):
+        return self.fromLat.getGuidProxies() + self.toLat.getGuidProxies()
+
+    def getEndpointsToMap(self):
+        latent1 = np.asarray(self.fromLat.getLatent())
+        latent2 = np.asarray(self.toLat.getLatent())
+        if latent1.shape[0] == 18 and latent2.shape[0] == 512:
+            return [self.toLat]
+        if latent1.shape[0] == 512 and latent2.shape[0] == 18:
+            return [self.fromLat]
+        return []
+
+    def getLatentsToMap(self):
+        return {latProxy.getName(): latProxy.getLatent() for latProxy in self.getEndpointsToMap() if not hasattr(latProxy, 'asDLat')}
+
+    def setMappedLatents(self, dlatents):
+        for latProxy in self.getEndpointsToMap():
+            if latProxy.getName() in dlatents and not hasattr(latProxy, 'asDLat'):
+                latProxy.asDLat = dlatents[latProxy.getName()]
+
+    def getLatent(self, engine):
+        latent1 = np.array(self.fromLat.getLatent(engine))
+        latent2 = np.array(self.toLat.getLatent(engine))
 
         if(latent1.shape[0] == 18 and latent2.shape[0] == 512):
             if not hasattr(self.toLat, 'asDLat'):
-                self.toLat.asDLat = toDLat(Gs, latent2)
+                self.toLat.asDLat = toDLat(engine, latent2)
             latent2 = self.toLat.asDLat
 
         if(latent1.shape[0] == 512 and latent2.shape[0] == 18):
             if not hasattr(self.fromLat, 'asDLat'):
-                self.fromLat.asDLat = toDLat(Gs, latent1)
+                self.fromLat.asDLat = toDLat(engine, latent1)
             latent1 = self.fromLat.asDLat
 
         return latent1 * (1 - self.p) + latent2 * self.p
 
 class LatentByMultiLerp(LatentProxy):
+    cacheLatentsToMap = False # scaled by their amounts
+
     def __init__(self, multiLerps):
         self.multiLerps = multiLerps
         names = [latProxy.getName() for [_,latProxy] in self.multiLerps]
@@ -255,8 +354,26 @@ class LatentByMultiLerp(LatentProxy):
         name = self.getName()
         return [ name[:12], name[12:14] ]
 
-    def getLatent(self, Gs):
-        latents = [amount * np.array(latProxy.getLatent(Gs)) for [amount,latProxy] in self.multiLerps]
+    def getGuidProxies(self):
+        return [guidProxy for [_,latProxy] in self.multiLerps for guidProxy in latProxy.getGuidProxies()]
+
+    def getLatentsToMap(self):
+        # getLatent maps each latent already scaled by its amount
+        if not any(np.asarray(latProxy.getLatent()).shape[0] == 18 for [_,latProxy] in self.multiLerps):
+            return {}
+        return {self.getScaledName(amount, latProxy): amount * np.asarray(latProxy.getLatent()) for [amount,latProxy] in self.multiLerps
+                if not hasattr(latProxy, 'asDLat') and np.asarray(latProxy.getLatent()).shape[0] == 512}
+
+    def getScaledName(self, amount, latProxy):
+        return f"{amount!r}*{latProxy.getName()}"
+
+    def setMappedLatents(self, dlatents):
+        for [amount,latProxy] in self.multiLerps:
+            if self.getScaledName(amount, latProxy) in dlatents and not hasattr(latProxy, 'asDLat'):
+                latProxy.asDLat = dlatents[self.getScaledName(amount, latProxy)]
+
+    def getLatent(self, engine):
+        latents = [amount * np.array(latProxy.getLatent(engine)) for [amount,latProxy] in self.multiLerps]
 
         isAnyDlat = False
         for l in latents:
@@ -268,15 +385,55 @@ class LatentByMultiLerp(LatentProxy):
             for idx, lat in enumerate(latents):
                 latProxy = self.multiLerps[idx][1]
                 if not hasattr(latProxy, 'asDLat'):
-                    latProxy.asDLat = toDLat(Gs, lat)
+                    latProxy.asDLat = toDLat(engine, lat)
             latents = [latProxy.asDLat for [_,latProxy] in self.multiLerps]
 
         return np.sum(latents,0)
 
+def loadGuidLatents(latentProxies):
+    '''
+    Loads the latents of every LatentByGuid that latentProxies are made from and hasn't been loaded yet,
+    from the guid latent cache, then all the rest in one query. Raises KeyError if any guid isn't in the database
+    '''
+    toLoad = {}
+    for latentProxy in latentProxies:
+        for guidProxy in latentProxy.getGuidProxies():
+            if guidProxy.latent is None:
+                toLoad.setdefault(str(guidProxy.guid), []).append(guidProxy)
+    if not toLoad:
+        return
+    latents = guidLatentCache.getMany(list(toLoad))
+    missing = [guid for guid in toLoad if guid not in latents]
+    if missing:
+        countDbRoundTrip()
+        for record in db.latents.find({'_id': {'$in': missing}}, recordProjection):
+            latents[record['_id']] = decodeLatent(record)
+            guidLatentCache.put(record['_id'], latents[record['_id']])
+    for guid, guidProxies in toLoad.items():
+        if guid not in latents:
+            raise KeyError(f'Cannot find latent for guid {guid}')
+        for guidProxy in guidProxies:
+            guidProxy.latent = latents[guid]
+
+# Priority classes for generation jobs, interactive requests go before bulk work
+PRIORITY_FACE = 0
+PRIORITY_LINK_PREVIEW = 1
+PRIORITY_MORPH_FRAME = 2
+PRIORITY_BULK = 3
+
+# How long a request waits for a job before giving up on it
+job_timeout_seconds = 30
+
 class GenerateImageJob:
-    def __init__(self, latentproxy, name):
+    def __init__(self, latentproxy, name, priority=PRIORITY_FACE, timeout=None):
         self.latentproxy = latentproxy
         self.name = name
+        self.priority = priority
+        self.deadline = time.time() + (timeout or job_timeout_seconds)
+        self.cancelled = False
+        self.endpoint = currentEndpoint()
+        self.traceContext = tracer.currentSpan().context
+        self.queuedAt = time.time()
         self.evt = threading.Event()
 
     def __str__(self):
@@ -286,13 +443,102 @@ class GenerateImageJob:
         self.img = img
         self.evt.set()
 
-    def wait_for_img(self, timeout):
+    def cancel(self):
+        '''
+        Nobody is waiting for this job anymore, so the worker should skip it
+        '''
+        self.cancelled = True
+
+    def isStale(self):
+        return self.cancelled or time.time() > self.deadline
+
+    def wait_for_img(self, timeout=None):
+        '''
+        Waits until the job's deadline, or for timeout seconds if given.
+        Cancels the job if it gives up so that it doesn't waste the generator
+        '''
+        if timeout is None:
+            timeout = max(0.0, self.deadline - time.time())
         if self.evt.wait(timeout):
             return self.img
         else:
+            self.cancel()
             return None
 
 
+class SingleFlight:
+    '''
+    Coalesces concurrent calls for the same key, so that only the first caller
+    does the work and every caller arriving while it is in flight shares its
+    result (or its exception) rather than repeating it
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.inflight.get(key)
+            isLeader = call is None
+            if isLeader:
+                call = {'evt': threading.Event(), 'result': None, 'error': None}
+                self.inflight[key] = call
+
+        if not isLeader:
+            coalescedRequestsCounter.inc()
+            call['evt'].wait()
+            if call['error']:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call['evt'].set()
+
+
+def encodeImages(img, outputs):
+    '''
+    Returns img resized and encoded for each (dim, fileFormat, saveParams) in outputs, in the encode pool if there is one.
+    saveParams are on top of the configured encoder settings for the format
+    '''
+    outputs = [(dim, fileFormat, dict(encoderSettings.get(fileFormat, {}), **saveParams)) for dim, fileFormat, saveParams in outputs]
+    if encodePool is not None:
+        # resizing is done in the pool too, so it is part of this stage
+        with timeStage('encode'):
+            return encodePool.encode(img, outputs)
+    encoded = []
+    for dim, fileFormat, saveParams in outputs:
+        resized = resizeImage(img, dim) if dim and img.size != (dim, dim) else img
+        with timeStage('encode'):
+            encoded.append(resizeAndEncode(resized, fileFormat, **saveParams))
+    return encoded
+
+def storeImages(img, outputs, **saveParams):
+    '''
+    Resizes and encodes img for each (name, fileFormat, dim) in outputs, dim None keeps its size,
+    and puts them in storage. Storage writes are atomic so concurrent readers never see a partially written image
+    '''
+    encoded = encodeImages(img, [(dim, fileFormat, saveParams) for _, fileFormat, dim in outputs])
+    for (name, _, _), data in zip(outputs, encoded):
+        with timeStage('write'):
+            storage.put(name, data)
+        trackAccess(name, len(data))
+
+def storeImage(name, img, fileFormat, dim=None, **saveParams):
+    storeImages(img, [(name, fileFormat, dim)], **saveParams)
+
+def resizeImage(img, image_dim):
+    with timeStage('resize'):
+        return img.resize((image_dim, image_dim), PIL.Image.ANTIALIAS)
+
 
 default_image_dim = 300
 
@@ -301,10 +547,74 @@ requestTimeSummary = Summary('request_processing_seconds',
 imagesGenCounter = Counter('image_generating', 'Number of images generated')
 imageEncodedCounter = Counter('image_encoding', 'Number of images encoded')
 jobQueue = Gauge('job_queue', 'Number of jobs in the queue')
+jobQueueByClass = Gauge('job_queue_class', 'Number of jobs in the queue per priority class', ['priority_class'])
 generatorNetworkTime = Summary('generator_network_seconds', 'Time taken to run \
                                 the generator network')
 ffmpegTimeSummary = Summary('ffmpeg_processing_seconds',
                              'Time spent running ffmpeg')
+imageCacheHits = Counter('image_cache_hits', 'Number of requests served from the in memory image cache')
+imageCacheMisses = Counter('image_cache_misses', 'Number of requests not found in the in memory image cache')
+imageCacheEvictions = Counter('image_cache_evictions', 'Number of images evicted from the in memory image cache')
+imageCacheBytes = Gauge('image_cache_bytes', 'Total size of images held in the in memory image cache')
+cacheGcDeletedBytes = Counter('cache_gc_deleted_bytes', 'Bytes of generated media deleted to stay within budget', ['category'])
+batchSizeHistogram = Histogram('generator_batch_size', 'Number of jobs in each batch run by the worker',
+                               buckets=(1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 32))
+batchAssemblySeconds = Histogram('generator_batch_assembly_seconds', 'Time spent waiting for more jobs \
+                                 to fill a batch after the first arrived', buckets=(.001, .0025, .005, .01, .02, .05, .1))
+staleJobsCounter = Counter('generator_jobs_skipped', 'Number of jobs the worker skipped because \
+                           they were cancelled or past their deadline', ['reason'])
+generatorSecondsSaved = Counter('generator_seconds_saved', 'Estimated generator time saved \
+                                by skipping stale jobs')
+coalescedRequestsCounter = Counter('coalesced_requests', 'Number of requests \
+                                    that shared an identical in-flight generation')
+pipelineStageSeconds = Histogram('pipeline_stage_seconds', 'Time spent in each stage of generating and \
+                                 serving media, by the endpoint it was for', ['stage', 'endpoint'],
+                                 buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+jobBatchSize = Histogram('generator_job_batch_size', 'Size of the batch each job was generated in, \
+                         by the endpoint it was for', ['endpoint'], buckets=(1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 32))
+mediaCacheResults = Counter('media_cache_results', 'Requests for generated media by endpoint, format \
+                            and whether it was found in memory, in storage or had to be generated', ['endpoint', 'format', 'result'])
+encodePoolProcesses = Gauge('encode_pool_processes', 'Number of processes in the encode pool')
+encodePoolBusySeconds = Counter('encode_pool_busy_seconds', 'Time the encode pool processes spent resizing \
+                                and encoding, divide its rate by encode_pool_processes for utilization')
+dlatentCacheResults = Counter('dlatent_cache_results', 'Lookups of mapped latents by whether they were found \
+                              in memory, on disk or had to be mapped', ['result'])
+dbRoundTrips = Histogram('db_round_trips_per_request', 'Number of MongoDB queries made while handling each request, \
+by endpoint', ['endpoint'], buckets=(0, 1, 2, 3, 5, 10, 20))
+guidLatentCacheResults = Counter('guid_latent_cache_results', 'Lookups of registered latents by guid by whether they were \
+in the in memory cache', ['result'])
+masterWritesPending = Gauge('master_writes_pending', 'Number of master images waiting to be written in the background')
+encodePoolInFlight = Gauge('encode_pool_in_flight', 'Number of images being encoded or waiting for the encode pool')
+
+def currentEndpoint():
+    '''
+    The flask endpoint being handled, for labelling metrics, or "none" outside of a request
+    '''
+    if flask.has_request_context() and request.endpoint:
+        return request.endpoint
+    return "none"
+
+# sampled requests are traced through the queue into the worker's batches, see tracing.py
+tracer = tracerFromEnv("checkface")
+
+def countDbRoundTrip():
+    '''
+    Counts a MongoDB query towards db_round_trips_per_request
+    '''
+    if flask.has_request_context():
+        flask.g.dbRoundTrips = flask.g.get('dbRoundTrips', 0) + 1
+
+@contextlib.contextmanager
+def timeStage(stage, endpoint=None):
+    with pipelineStageSeconds.labels(stage, endpoint or currentEndpoint()).time(), tracer.span(stage):
+        yield
+
+def enqueue(job: GenerateImageJob):
+    with tracer.span('enqueue', attributes={'job': job.name, 'priority': jobClassNames[job.priority]}):
+        # here rather than in the worker, so a guid that doesn't exist fails its own request, not a whole batch
+        loadGuidLatents([job.latentproxy])
+        q.put(job)
+        jobQueue.inc(1)
 
 app = flask.Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
@@ -319,6 +629,71 @@ app.logger.info(f'mongodb_conn_str: {mongodb_conn_str}')
 app.logger.info(f'client:           {client}')
 app.logger.info(f'db:               {db}')
 
+@app.before_request
+def start_request_span():
+    # continues the caller's trace if it sent a traceparent header
+    parent = SpanContext.fromTraceparent(request.headers.get('traceparent'))
+    span = tracer.startSpan(request.endpoint or "request", parent=parent, attributes={
+        'http.method': request.method, 'http.target': request.full_path})
+    flask.g.traceSpan = span
+    flask.g.previousTraceSpan = tracer.setCurrentSpan(span)
+
+@app.after_request
+def add_traceparent(response):
+    span = flask.g.get('traceSpan')
+    if span is not None and span.sampled:
+        span.setAttribute('http.status_code', response.status_code)
+        response.headers['traceparent'] = span.context.toTraceparent()
+    return response
+
+@app.teardown_request
+def end_request_span(exc):
+    span = flask.g.get('traceSpan')
+    if span is None:
+        return
+    if exc is not None:
+        span.setAttribute('error', str(exc))
+    tracer.setCurrentSpan(flask.g.previousTraceSpan)
+    span.end()
+
+@app.teardown_request
+def observe_db_round_trips(exc):
+    dbRoundTrips.labels(currentEndpoint()).observe(flask.g.get('dbRoundTrips', 0))
+
+# Bump this if the images generated for the same request ever change,
+# so clients stop trusting what they cached against the old etags
+outputVersion = "1"
+immutableCacheControl = "public, max-age=31536000, immutable"
+
+def getRequestETag(request):
+    '''
+    The etag of a deterministic endpoint is just a hash of the request itself,
+    so it can be checked without touching the disk or the latents
+    '''
+    args = sorted(request.args.items(multi=True))
+    key = f"{outputVersion}:{request.path}?{urllib.parse.urlencode(args)}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def deterministic_response(view):
+    '''
+    For endpoints whose response is a pure function of their query args.
+    Answers revalidations with a 304 before doing any work, and marks
+    successful responses immutable so browsers and cloudflare stop revalidating
+    '''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = getRequestETag(request)
+        if request.if_none_match.contains_weak(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = immutableCacheControl
+        return response
+    return wrapper
+
 @app.route('/status/', methods=['GET'])
 def status():
     return ''
@@ -328,6 +703,8 @@ def status():
 def home():
     return 'It works'
 
+latentStorageDtype = latentStorageDtypeFromEnv()
+
 def registerLatent(latentArray):
     try:
         latent_data = np.array(latentArray).astype('float32', casting='same_kind')
@@ -340,7 +717,11 @@ def registerLatent(latentArray):
     else:
         return (False, 'Latent must be array of shape (512,) or (18, 512)')
     guid = uuid.uuid4()
-    db.latents.insert_one({'_id':str(guid), 'type': latent_type, 'latent':latent_data.tolist()})
+    fields = encodeLatent(latent_data, latentStorageDtype)
+    countDbRoundTrip()
+    db.latents.insert_one({'_id':str(guid), 'type': latent_type, **fields})
+    # its faces are usually asked for straight after, this saves reading it back
+    guidLatentCache.put(str(guid), decodeLatent(fields))
     return (True, str(guid))
 
 @app.route('/api/registerlatent/', methods=['POST'])
@@ -352,8 +733,107 @@ def registerLatentApi():
     else:
         return flask.Response(msg, status=400)
 
+jobClassNames = {
+    PRIORITY_FACE: 'face',
+    PRIORITY_LINK_PREVIEW: 'linkpreview',
+    PRIORITY_MORPH_FRAME: 'morphframe',
+    PRIORITY_BULK: 'bulk',
+}
+
+# everything generated is kept here, keyed by paths relative to checkfacedata
+storage = indexFromEnv(storageFromEnv(os.path.join(os.getcwd(), "checkfacedata")), scanPrefixes)
+
+# mapped latents depend on the engine, so each engine has its own table on disk
+dlatentCacheDiskMB = int(os.getenv('DLATENT_CACHE_DISK_MB', '0'))
+dlatentCache = DLatentCache(int(os.getenv('DLATENT_CACHE_ITEMS', '1000')),
+                            os.path.join(os.getenv('DLATENT_CACHE_DIR', os.path.join(os.getcwd(), "checkfacedata", "dlatents")),
+                                         engineNameFromEnv()) if dlatentCacheDiskMB > 0 else None,
+                            dlatentCacheDiskMB * 1024 * 1024, results=dlatentCacheResults)
+
+# registered latents by guid, which would otherwise be queried for on every request that uses them
+guidLatentCache = GuidLatentCache(int(os.getenv('GUID_LATENT_CACHE_ITEMS', '1000')), results=guidLatentCacheResults)
+
+# only tracks accesses and collects when at least one CACHE_BUDGET_<CATEGORY>_MB is set
+cacheCollector = None
+if budgetsFromEnv():
+    cacheCollector = CacheCollector(storage, defaultDbPath(), budgetsFromEnv(), deletedBytesCounter=cacheGcDeletedBytes)
+    cacheCollector.start(float(os.getenv('CACHE_GC_INTERVAL_SECONDS', '10')))
+
+def trackAccess(name, size=None):
+    if cacheCollector is not None:
+        cacheCollector.touch(name, size)
+
+# JPEG and WebP quality etc., used wherever images are encoded
+encoderSettings = encoderSettingsFromEnv()
+
+# the encode pool was started before any threads, at the top
+if encodePool is not None:
+    encodePool.busySeconds = encodePoolBusySeconds
+    encodePool.inFlight = encodePoolInFlight
+    encodePoolProcesses.set(encodeProcesses)
+
 # such a queue
-q = queue.Queue()
+# weights are each class's share of the worker when all of them have jobs waiting
+q = PriorityJobQueue({
+        PRIORITY_FACE: 8,
+        PRIORITY_LINK_PREVIEW: 4,
+        PRIORITY_MORPH_FRAME: 2,
+        PRIORITY_BULK: 1,
+    }, starvationSeconds=float(os.getenv('JOB_STARVATION_SECONDS', '5')))
+
+for priority, className in jobClassNames.items():
+    jobQueueByClass.labels(className).set_function(lambda priority=priority: q.qsize(priority))
+
+faceSingleFlight = SingleFlight()
+masterSingleFlight = SingleFlight()
+
+# encoded images by output file name, so hot faces don't touch the disk at all
+imageBytesCache = ByteCache(
+    maxBytes=int(os.getenv('IMAGE_CACHE_MB', '256')) * 1024 * 1024,
+    maxItemBytes=int(os.getenv('IMAGE_CACHE_MAX_ITEM_KB', '1024')) * 1024,
+    hitCounter=imageCacheHits, missCounter=imageCacheMisses,
+    evictionCounter=imageCacheEvictions, bytesGauge=imageCacheBytes)
+
+def readCachedFile(name, mimetype):
+    '''
+    Returns the contents of name from the in memory image cache, reading it into the cache if it isn't there yet
+    '''
+    trackAccess(name)
+    entry = imageBytesCache.get(name)
+    if entry is None:
+        data = storage.get(name)
+        if data is None:
+            raise FileNotFoundError(name)
+        entry = (data, mimetype)
+        imageBytesCache.put(name, *entry)
+    return entry[0]
+
+def sendCachedFile(name, mimetype):
+    '''
+    Sends name from the in memory image cache, reading it into the cache if it isn't there yet
+    '''
+    start = time.time()
+    sendTime = pipelineStageSeconds.labels('send', currentEndpoint())
+    data = readCachedFile(name, mimetype)
+    response = flask.Response(data, mimetype=mimetype)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.get_send_file_max_age(name)
+    # closed once the body has been written to the client
+    response.call_on_close(lambda: sendTime.observe(time.time() - start))
+    return response
+
+def isGenerated(name, fileFormat):
+    '''
+    Returns whether name is already in the image cache or storage, counting which by endpoint and format
+    '''
+    if name in imageBytesCache:
+        result = "memory"
+    elif storage.exists(name):
+        result = "storage"
+    else:
+        result = "miss"
+    mediaCacheResults.labels(currentEndpoint(), fileFormat.lower(), result).inc()
+    return result != "miss"
 
 def argIsTrue(request, param_name):
     argval = request.args.get(param_name)
@@ -362,10 +842,12 @@ def argIsTrue(request, param_name):
     return argval == 'true'
 
 def defaultedRequestInt(request, param_name, default_val, min_val, max_val):
-    val = default_val
+    # if key doesn't exist, returns None
+    return defaultedInt(request.args.get(param_name), default_val, min_val, max_val)
+
+def defaultedInt(val, default_val, min_val, max_val):
     try:
-        # if key doesn't exist, returns None
-        val = int(request.args.get(param_name))
+        val = int(val)
         if (val is None or
                 val < min_val or
                 val > max_val):
@@ -377,36 +859,144 @@ def defaultedRequestInt(request, param_name, default_val, min_val, max_val):
 def getRequestedImageDim(request):
     return defaultedRequestInt(request, 'dim', default_image_dim, 10, 1024)
 
-def handle_generate_image_request(latentProxy: LatentProxy, image_dim, isWebp):
-    partitions = os.path.join(*latentProxy.getShardPartitions())
-    imgsDir = os.path.join(os.getcwd(), "checkfacedata", "outputImages", partitions)
-    os.makedirs(imgsDir, exist_ok=True)
+def getFaceImageFile(latentProxy: LatentProxy, image_dim, isWebp):
+    '''
+    Returns the file name, PIL format and mimetype for a face image
+    '''
+    imgsDir = posixpath.join("outputImages", *latentProxy.getShardPartitions())
 
     fileExt = "webp" if isWebp else "jpg"
     fileFormat = "WEBP" if isWebp else "JPEG"
     fileMimetype = "image/webp" if isWebp else "image/jpg"
-    name = os.path.join(imgsDir, f"{latentProxy.getName()}_{image_dim}.{fileExt}")
+    name = posixpath.join(imgsDir, f"{latentProxy.getName()}_{image_dim}.{fileExt}")
+    return name, fileFormat, fileMimetype
+
+def handle_generate_image_request(latentProxy: LatentProxy, image_dim, isWebp):
+    name, fileFormat, fileMimetype = getFaceImageFile(latentProxy, image_dim, isWebp)
     app.logger.info(f"image file name: {name}")
 
-    if not os.path.isfile(name):
-        job = GenerateImageJob(latentProxy, latentProxy.getName())
-        q.put(job)
-        jobQueue.inc(1)
-        img = job.wait_for_img(30)
-        if img:
-            resized = img.resize(
-                    (image_dim, image_dim), PIL.Image.ANTIALIAS)
-            resized.save(name, fileFormat)
+    if not isGenerated(name, fileFormat):
+        # many clients often ask for the same face at once, so only the first
+        # one queues a job and everyone else waits for that to be saved
+        faceSingleFlight.do(name, lambda: generate_image_file(latentProxy, name, image_dim, fileFormat))
+    else:
+        app.logger.info(f"Image file already exists: {name}")
+    try:
+        return sendCachedFile(name, fileMimetype)
+    except FileNotFoundError:
+        # deleted since the storage index last saw it, eg. by cachegc.py in another process.
+        # The failed read removed it from the index, so it is generated again
+        app.logger.info(f"Image file has gone missing, generating it again: {name}")
+        faceSingleFlight.do(name, lambda: generate_image_file(latentProxy, name, image_dim, fileFormat))
+        return sendCachedFile(name, fileMimetype)
+
+def generate_image_file(latentProxy: LatentProxy, name, image_dim, fileFormat):
+    # a previous flight may have finished between our check and becoming the leader
+    if storage.exists(name):
+        return
+    img = loadMasterImage(latentProxy)
+    if img is None:
+        img = masterSingleFlight.do(latentProxy.getName(), lambda: render_master_image(latentProxy))
+    storeImage(name, img, fileFormat, image_dim)
+
+saveMasterImages = os.getenv('SAVE_MASTER_IMAGES', 'True').lower() in ['true', '1']
+masterImagesDir = "masterImages"
+
+def getMasterImagePath(latentProxy: LatentProxy):
+    return posixpath.join(masterImagesDir, *latentProxy.getShardPartitions(), f"{latentProxy.getName()}.png")
+
+def loadMasterImage(latentProxy: LatentProxy):
+    '''
+    Returns the stored native resolution image for the latent, or None if it has never been rendered
+    '''
+    masterName = getMasterImagePath(latentProxy)
+    data = storage.get(masterName)
+    if data is None:
+        return None
+    app.logger.info(f"Deriving from master image: {masterName}")
+    img = PIL.Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+# masters are written on a background thread, as a 1024px png encode and write
+# would otherwise be paid by every request that generates a face
+masterWriter = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+maxMasterWritesPending = int(os.getenv('MASTER_WRITE_QUEUE', '32'))
+masterWritesLock = threading.Lock()
+numMasterWritesPending = 0
+
+def writeMasterImage(masterName, img):
+    global numMasterWritesPending
+    try:
+        # fastest zlib level, these are written far more often than they would benefit from being smaller
+        storeImage(masterName, img, 'PNG', compress_level=1)
+    except Exception:
+        app.logger.exception(f"Writing master image failed: {masterName}")
+    finally:
+        with masterWritesLock:
+            numMasterWritesPending -= 1
+        masterWritesPending.dec()
+
+def saveMasterImage(latentProxy: LatentProxy, img, background=True):
+    '''
+    Stores the worker's native resolution output losslessly,
+    so every later dim and format for this latent is just a resize and encode.
+    In the background unless background is False. Masters are only a shortcut, so when
+    MASTER_WRITE_QUEUE are already waiting this one is dropped rather than queued
+    '''
+    global numMasterWritesPending
+    if not saveMasterImages:
+        return
+    masterName = getMasterImagePath(latentProxy)
+    if not background:
+        storeImage(masterName, img, 'PNG', compress_level=1)
+        return
+    with masterWritesLock:
+        if numMasterWritesPending >= maxMasterWritesPending:
+            app.logger.info(f"Too many master images waiting to be written, skipping {masterName}")
+            return
+        numMasterWritesPending += 1
+    masterWritesPending.inc()
+    masterWriter.submit(writeMasterImage, masterName, img)
+
+def render_master_image(latentProxy: LatentProxy):
+    return render_fullsize_images([latentProxy])[0]
+
+def render_fullsize_images(latentProxies, priority=PRIORITY_FACE):
+    '''
+    Returns the native resolution image for each latent, deriving from stored masters where possible.
+    All of the rest are queued at once so they are generated in as few batches as possible
+    '''
+    imgs = {}
+    jobs = {}
+    for latentProxy in latentProxies:
+        name = latentProxy.getName()
+        if name in imgs or name in jobs:
+            continue
+        img = loadMasterImage(latentProxy)
+        if img is not None:
+            imgs[name] = img
         else:
-            raise Exception("Generating image failed or timed out")
+            jobs[name] = GenerateImageJob(latentProxy, name, priority)
 
+    loadGuidLatents([job.latentproxy for job in jobs.values()])
+    for job in jobs.values():
+        enqueue(job)
 
-    else:
-        app.logger.info(f"Image file already exists: {name}")
-    return send_file(name, mimetype=fileMimetype)
+    for name, job in jobs.items():
+        img = job.wait_for_img()
+        if not img:
+            for job in jobs.values():
+                job.cancel()
+            raise Exception("Generating image failed or timed out")
+        saveMasterImage(job.latentproxy, img)
+        imgs[name] = img
+
+    return [imgs[latentProxy.getName()] for latentProxy in latentProxies]
 
 
 @app.route('/api/<string:textValue>', methods=['GET'])
+@deterministic_response
 def image_generation_legacy(textValue):
     '''
     string as a type will accept anything without a slash
@@ -431,13 +1021,16 @@ def useTextOrSeedOrGuid(textValue: str, seedstr: str, guidstr: str):
     # fallback on text value if nothing else
     return LatentByTextValue(textValue)
 
+def getIndexedLatent(request, i):
+    textValue = request.args.get('value' + str(i))
+    seedstr = request.args.get('seed' + str(i))
+    guidstr = request.args.get('guid' + str(i))
+    return useTextOrSeedOrGuid(textValue, seedstr, guidstr)
+
 def getMultiLerpLatent(numMulti, request):
     multiLerp = []
     for i in range(numMulti):
-        textValue = request.args.get('value' + str(i))
-        seedstr = request.args.get('seed' + str(i))
-        guidstr = request.args.get('guid' + str(i))
-        latentProxy = useTextOrSeedOrGuid(textValue, seedstr, guidstr)
+        latentProxy = getIndexedLatent(request, i)
         amountstr = request.args.get('amount' + str(i))
         if amountstr:
             amount = max(-2.0, min(2.0, float(amountstr)))
@@ -464,6 +1057,7 @@ def getRequestedFormat(request):
 
 
 @app.route('/api/face/', methods=['GET'])
+@deterministic_response
 def image_generation():
     with requestTimeSummary.time():
         latentProxy = getRequestLatent(request)
@@ -472,10 +1066,143 @@ def image_generation():
         return handle_generate_image_request(latentProxy, image_dim, isWebp)
 
 
+max_batch_faces = 100
+
+@app.route('/api/faces/', methods=['POST'])
+def batch_image_generation():
+    '''
+    Generates many faces in one request. Every face that isn't already cached is
+    submitted together, so they fill whole generator batches instead of each
+    waiting in the queue on its own.
+    Returns a zip of the images, or if "response" is "manifest",
+    a json list of /api/face/ urls which will then all be cache hits
+    '''
+    body = request.get_json(silent=True) or {}
+    specs = body.get('faces')
+    if not isinstance(specs, list) or not 0 < len(specs) <= max_batch_faces:
+        return flask.Response(f'faces must be a list of 1 to {max_batch_faces} face specs', status=400)
+
+    image_dim = defaultedInt(body.get('dim'), default_image_dim, 10, 1024)
+    isWebp = str(body.get('format', 'jpg')).strip().lower() == "webp"
+    try:
+        faceArgs = [getFaceSpecArgs(spec) for spec in specs]
+        latentProxies = [useTextOrSeedOrGuid(args.get('value'), args.get('seed'), args.get('guid')) for args in faceArgs]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return flask.Response(f'Invalid face spec: {e}', status=400)
+
+    files = [getFaceImageFile(latentProxy, image_dim, isWebp) for latentProxy in latentProxies]
+    uncached = [(latentProxy, name, fileFormat) for latentProxy, (name, fileFormat, _) in zip(latentProxies, files)
+                if name not in imageBytesCache]
+    stored = storage.existsMany([name for _, name, _ in uncached])
+    missing = {}
+    for (latentProxy, name, fileFormat), isStored in zip(uncached, stored):
+        if not isStored:
+            missing[name] = (latentProxy, fileFormat)
+    formatLabel = files[0][1].lower()
+    mediaCacheResults.labels(currentEndpoint(), formatLabel, "memory").inc(len(files) - len(uncached))
+    mediaCacheResults.labels(currentEndpoint(), formatLabel, "storage").inc(sum(stored))
+    mediaCacheResults.labels(currentEndpoint(), formatLabel, "miss").inc(len(uncached) - sum(stored))
+
+    app.logger.info(f"Batch of {len(files)} faces with {len(missing)} to generate")
+    if missing:
+        try:
+            # up to max_batch_faces jobs at once, so they mustn't hold up single faces
+            imgs = render_fullsize_images([latentProxy for latentProxy, _ in missing.values()], priority=PRIORITY_BULK)
+        except KeyError as e:
+            return flask.Response(f'Invalid face spec: {e}', status=400)
+        for (name, (_, fileFormat)), img in zip(missing.items(), imgs):
+            storeImage(name, img, fileFormat, image_dim)
+
+    if body.get('response') == 'manifest':
+        fileExt = "webp" if isWebp else "jpg"
+        urls = [flask.url_for('image_generation', dim=image_dim, format=fileExt, _external=True, **args)
+                for args in faceArgs]
+        return jsonify({'faces': urls})
+
+    zipBuffer = io.BytesIO()
+    # images are already compressed, so just store them
+    with zipfile.ZipFile(zipBuffer, 'w', zipfile.ZIP_STORED) as zf:
+        for i, (latentProxy, (name, fileFormat, mimetype)) in enumerate(zip(latentProxies, files)):
+            try:
+                data = readCachedFile(name, mimetype)
+            except FileNotFoundError:
+                # deleted since the existence check, see handle_generate_image_request
+                generate_image_file(latentProxy, name, image_dim, fileFormat)
+                data = readCachedFile(name, mimetype)
+            zf.writestr(f"{i:03d}_{posixpath.basename(name)}", data)
+    return flask.Response(zipBuffer.getvalue(), mimetype='application/zip')
+
+def getFaceSpecArgs(spec):
+    '''
+    Turns a face spec from a json body into the query args /api/face/ would take for it
+    '''
+    if spec.get('guid'):
+        return {'guid': str(spec['guid'])}
+    if spec.get('seed') is not None:
+        return {'seed': str(spec['seed'])}
+    return {'value': str(spec.get('value') or '')}
+
+
+outputSpritesDir = "outputSprites"
+
+def getSpriteLayout(request):
+    '''
+    Returns (num_faces, image_dim, cols, rows) for a sprite request
+    '''
+    numFaces = defaultedRequestInt(request, 'num_faces', 1, 1, max_batch_faces)
+    image_dim = defaultedRequestInt(request, 'dim', 64, 10, 256)
+    cols = defaultedRequestInt(request, 'cols', int(math.ceil(math.sqrt(numFaces))), 1, numFaces)
+    rows = (numFaces - 1) // cols + 1
+    return numFaces, image_dim, cols, rows
+
+@app.route('/api/sprite/', methods=['GET'])
+@deterministic_response
+def sprite_generation():
+    '''
+    A single grid image of num_faces faces, specified by value0, seed1, guid2 etc.
+    so a page listing many hashes needs just one request, one batch and one encode.
+    Face i is at x = (i % cols) * dim, y = (i // cols) * dim, see /api/sprite/map/
+    '''
+    numFaces, image_dim, cols, rows = getSpriteLayout(request)
+    isWebp = getRequestedFormat(request) == "webp"
+    latentProxies = [getIndexedLatent(request, i) for i in range(numFaces)]
+
+    # sprites are cached by the ordered list of faces in them
+    spriteHash = hashlib.sha256("-".join(latentProxy.getName() for latentProxy in latentProxies).encode('utf-8')).hexdigest()
+    fileExt = "webp" if isWebp else "jpg"
+    fileFormat = "WEBP" if isWebp else "JPEG"
+    fileMimetype = "image/webp" if isWebp else "image/jpg"
+    name = posixpath.join(outputSpritesDir, spriteHash[:2], f"{spriteHash}_n{numFaces}c{cols}x{image_dim}.{fileExt}")
+
+    if not isGenerated(name, fileFormat):
+        # a sheet is up to 100 faces, which mustn't hold up single faces
+        imgs = render_fullsize_images(latentProxies, priority=PRIORITY_BULK)
+        faces = np.stack([np.asarray(resizeImage(img, image_dim)) for img in imgs])
+        grid = misc.create_image_grid(faces.transpose(0, 3, 1, 2), (cols, rows)) # NHWC -> NCHW
+        spriteIm = PIL.Image.fromarray(grid.transpose(1, 2, 0), 'RGB')
+        storeImage(name, spriteIm, fileFormat)
+    else:
+        app.logger.info(f"Sprite file already exists: {name}")
+
+    return sendCachedFile(name, fileMimetype)
+
+@app.route('/api/sprite/map/', methods=['GET'])
+@deterministic_response
+def sprite_map():
+    '''
+    Where each face is in the /api/sprite/ image for the same query args
+    '''
+    numFaces, image_dim, cols, rows = getSpriteLayout(request)
+    offsets = [{'x': (i % cols) * image_dim, 'y': (i // cols) * image_dim} for i in range(numFaces)]
+    return jsonify({'width': cols * image_dim, 'height': rows * image_dim,
+                    'dim': image_dim, 'faces': offsets})
+
+
 @app.route('/api/hashdata/', methods=['GET'])
 def hashlatentdata():
     latentProxy = getRequestLatent(request)
-    latent = latentProxy.getLatent(Gs = None) # Only LatentByProxy needs Gs at the moment
+    loadGuidLatents([latentProxy]) # all in one query, rather than one each as a multilerp gets them
+    latent = latentProxy.getLatent(engine = None) # Only the lerps need the engine at the moment
     if latent.shape[0] == 512:
         ltype = "qlatent"
     else:
@@ -488,23 +1215,46 @@ def hashlatentdata():
 
     return jsonify(data)
 
-outputMorphsDir = os.path.join(os.getcwd(), "checkfacedata", "outputMorphs")
+outputMorphsDir = "outputMorphs"
 assetsDir = os.path.join(os.getcwd(), "checkfacedata", "assets")
-os.makedirs(outputMorphsDir, exist_ok=True)
 
 def getParentMorphdir(fromLatentProxy: LatentProxy, toLatentProxy: LatentProxy):
 
     partitions = fromLatentProxy.getShardPartitions() + toLatentProxy.getShardPartitions()
-    partitionsPart = os.path.join(*partitions)
-    return os.path.join(outputMorphsDir, partitionsPart,
+    partitionsPart = posixpath.join(*partitions)
+    return posixpath.join(outputMorphsDir, partitionsPart,
                     f"from {fromLatentProxy.getName()} to {toLatentProxy.getName()}")
 
 def getFramesMorphdir(parentMorphDir, num_frames, image_dim, isLinear):
     shape = "linear" if isLinear else "trig"
-    framesdir = os.path.join(parentMorphDir, "frames",
+    framesdir = posixpath.join(parentMorphDir, "frames",
                     f"{shape} n{num_frames}x{image_dim}")
     return framesdir
 
+def getMorphFrameFiles(framesdir, num_frames, framenums, isLinear = False):
+    '''
+    Returns (framenum, filename) for each of framenums, using the same file for mirrored trig frames
+    '''
+    if (num_frames % 2) == 0 and not isLinear:
+        # trig function is mirrored so flip to only first half
+        # eg. for num_frames = 10
+        # 0, 1, 2, 3, 4, 5, 6, 7, 8, 9
+        # is the same as
+        # 0, 1, 2, 3, 4, 5, 4, 3, 2, 1
+
+        framenums = [ i if i < num_frames / 2 or i >= num_frames else num_frames - i for i in framenums ]
+
+    return [ (i, posixpath.join(framesdir, f"img{i:03d}.jpg")) for i in framenums ]
+
+def getMorphAmounts(num_frames, isLinear = False):
+    '''
+    How far from the start each frame is, in reverse, so frame i is LatentByLerp(from, to, 1 - vals[i])
+    '''
+    if isLinear:
+        return np.linspace(1, 0, num_frames, True) # in reverse to work same as trig
+    else:
+        return [(math.sin(i + math.pi/2) + 1) * 0.5 for i in np.linspace(0, 2 * math.pi, num_frames, False)]
+
 def generate_morph_frames(fromLatentProxy: LatentProxy, toLatentProxy: LatentProxy, num_frames, image_dim, framenums, isLinear = False):
     """
     For each specified frame num,
@@ -530,18 +1280,8 @@ def generate_morph_frames(fromLatentProxy: LatentProxy, toLatentProxy: LatentPro
     framesdir = getFramesMorphdir(parentMorphdir, num_frames, image_dim, isLinear)
     app.logger.info(f"  parentMorphdir    {parentMorphdir}")
     app.logger.info(f"  framesdir         {framesdir}")
-    os.makedirs(framesdir, exist_ok=True)
-
-    if (num_frames % 2) == 0 and not isLinear:
-        # trig function is mirrored so flip to only first half
-        # eg. for num_frames = 10
-        # 0, 1, 2, 3, 4, 5, 6, 7, 8, 9
-        # is the same as
-        # 0, 1, 2, 3, 4, 5, 4, 3, 2, 1
 
-        framenums = [ i if i < num_frames / 2 or i >= num_frames else num_frames - i for i in framenums ]
-
-    frames = [ (i, os.path.join(framesdir, f"img{i:03d}.jpg")) for i in framenums ]
+    frames = getMorphFrameFiles(framesdir, num_frames, framenums, isLinear)
     app.logger.info(f"  frames:")
     for f in frames:
         app.logger.info(f"              {f}")
@@ -552,13 +1292,18 @@ def generate_morph_frames(fromLatentProxy: LatentProxy, toLatentProxy: LatentPro
     
     
     deduplicateBy = set() # keep all filenames in frames to return, but don't generate same file multiple times
-    if isLinear:
-        vals = np.linspace(1, 0, num_frames, True) # in reverse to work same as trig
-    else:
-        vals = [(math.sin(i + math.pi/2) + 1) * 0.5 for i in np.linspace(0, 2 * math.pi, num_frames, False)]
+    vals = getMorphAmounts(num_frames, isLinear)
 
     jobs = []
-    if all(os.path.isfile(fName) for fName in filenames):
+    # confirmed rather than taken from the storage index, as ffmpeg reads them by path,
+    # so one deleted by another process since the index saw it has to be generated again
+    existingFiles = set(fName for fName, exists in zip(filenames, storage.confirmMany(filenames)) if exists)
+    mediaCacheResults.labels(currentEndpoint(), "jpeg", "storage").inc(len(existingFiles))
+    mediaCacheResults.labels(currentEndpoint(), "jpeg", "miss").inc(len(set(filenames)) - len(existingFiles))
+    for fName in existingFiles:
+        # about to be used, so the collector leaves them alone
+        trackAccess(fName)
+    if len(existingFiles) == len(set(filenames)):
         if len(filenames) == 1:
             app.logger.info(f"  Frame already exists: {filenames[0]}")
         else:
@@ -567,65 +1312,82 @@ def generate_morph_frames(fromLatentProxy: LatentProxy, toLatentProxy: LatentPro
 
     for i, fName in frames:
         app.logger.info(f"      fName   {fName}")
-        if os.path.isfile(fName):
+        if fName in existingFiles:
             app.logger.info(f"    Frame already exists:   {fName}")
         elif not (fName in deduplicateBy):
             app.logger.info(f"    Create Latent:     {fName}")
             lerpLatentProxy = LatentByLerp(fromLatentProxy, toLatentProxy, 1 - vals[i])
-            job = GenerateImageJob(lerpLatentProxy, f"from {fromLatentProxy.getName()} to {toLatentProxy.getName()} n{num_frames}f{i}")
-            q.put(job)
-            jobQueue.inc(1)
+            job = GenerateImageJob(lerpLatentProxy, f"from {fromLatentProxy.getName()} to {toLatentProxy.getName()} n{num_frames}f{i}",
+                                   PRIORITY_MORPH_FRAME)
+            enqueue(job)
             jobs.append((job, fName, image_dim))
             deduplicateBy.add(fName)
 
             # also save full size FROM and TO images for posterity sake
             if i == 0:
-                FROM_IMAGE = os.path.join(parentMorphdir, "FROM.jpg")
-                if not os.path.isfile(FROM_IMAGE):
+                FROM_IMAGE = posixpath.join(parentMorphdir, "FROM.jpg")
+                if not storage.exists(FROM_IMAGE):
                     jobs.append((job, FROM_IMAGE, 1024))
 
             if (isLinear and i == num_frames - 1) or (i == num_frames / 2 and not isLinear):
-                TO_IMAGE = os.path.join(parentMorphdir, "TO.jpg")
-                if not os.path.isfile(TO_IMAGE):
+                TO_IMAGE = posixpath.join(parentMorphdir, "TO.jpg")
+                if not storage.exists(TO_IMAGE):
                     jobs.append((job, TO_IMAGE, 1024))
     if len(jobs) > 0:
         start = time.time()
-        imgs = [(job.wait_for_img(30), fName, dim) for (job, fName, dim) in jobs]
+        imgs = [(job.wait_for_img(), fName, dim) for (job, fName, dim) in jobs]
         diff = time.time() - start
         app.logger.info(f"")
         app.logger.info(f"Waited {diff:.2f} seconds for {len(imgs)} morph frames")
         app.logger.info(f"")
 
-        for img, fName, dim in imgs:
-            if not img:
-                raise Exception("Generating image failed or timed out")
-            img.resize((dim, dim), PIL.Image.ANTIALIAS).save(fName, 'JPEG')
+        if not all(img for img, _, _ in imgs):
+            for job, _, _ in jobs:
+                job.cancel()
+            raise Exception("Generating image failed or timed out")
+
+        # a frame and the FROM or TO image share a job, so its image is only sent to the encode pool once
+        outputsByJob = {}
+        for (job, _, _), (img, fName, dim) in zip(jobs, imgs):
+            outputsByJob.setdefault(job, (img, []))[1].append((fName, 'JPEG', dim))
+        for img, outputs in outputsByJob.values():
+            storeImages(img, outputs)
 
     return filenames
 
 def generate_link_preview(fromLatentProxy: LatentProxy, toLatentProxy: LatentProxy, preview_width):
     parentMorphdir = getParentMorphdir(fromLatentProxy, toLatentProxy)
-    previewsDir = os.path.join(parentMorphdir, "linkPreviews")
-    os.makedirs(previewsDir, exist_ok=True)
+    previewsDir = posixpath.join(parentMorphdir, "linkPreviews")
 
-    name = os.path.join(previewsDir, f"x{preview_width}.jpg")
+    name = posixpath.join(previewsDir, f"x{preview_width}.jpg")
 
-    if os.path.isfile(name):
+    if isGenerated(name, 'JPEG'):
         app.logger.info(f"Link preview file already exists: {name}")
         return name
 
     middleLatentProxy = LatentByLerp(fromLatentProxy, toLatentProxy, 0.5)
     latentProxies = [fromLatentProxy, toLatentProxy, middleLatentProxy]
-    jobs = [GenerateImageJob(latentProxy, f"from {fromLatentProxy.getName()} to {toLatentProxy.getName()} preview{i}") for i, latentProxy in enumerate(latentProxies)]
+    # the from and to faces can usually be derived from their masters, only render the rest
+    masters = [loadMasterImage(fromLatentProxy), loadMasterImage(toLatentProxy), None]
+    jobs = [GenerateImageJob(latentProxy, f"from {fromLatentProxy.getName()} to {toLatentProxy.getName()} preview{i}",
+                             PRIORITY_LINK_PREVIEW) if master is None else None
+            for i, (latentProxy, master) in enumerate(zip(latentProxies, masters))]
+    loadGuidLatents([job.latentproxy for job in jobs if job])
     for job in jobs:
-        q.put(job)
-        jobQueue.inc(1)
+        if job:
+            enqueue(job)
 
-    imgs = [job.wait_for_img(30) for job in jobs]
+    imgs = [job.wait_for_img() if job else master for job, master in zip(jobs, masters)]
 
-    for img in imgs:
-        if not img:
-            raise Exception("Generating link preview failed or timed out")
+    if not all(imgs):
+        for job in jobs:
+            if job:
+                job.cancel()
+        raise Exception("Generating link preview failed or timed out")
+
+    for latentProxy, job, img in zip([fromLatentProxy, toLatentProxy], jobs, imgs):
+        if job:
+            saveMasterImage(latentProxy, img)
 
     standardHeight = 628
     standardWidth = 1200
@@ -633,9 +1395,9 @@ def generate_link_preview(fromLatentProxy: LatentProxy, toLatentProxy: LatentPro
 
     faceDim = int(round(300 * preview_height / standardHeight))
     sumDim = int(round(512 * preview_height / standardHeight))
-    face1 = imgs[0].resize((faceDim, faceDim), PIL.Image.ANTIALIAS)
-    face2 = imgs[1].resize((faceDim, faceDim), PIL.Image.ANTIALIAS)
-    sumFace = imgs[2].resize((sumDim, sumDim), PIL.Image.ANTIALIAS)
+    face1 = resizeImage(imgs[0], faceDim)
+    face2 = resizeImage(imgs[1], faceDim)
+    sumFace = resizeImage(imgs[2], sumDim)
 
     previewIm = PIL.Image.new("RGB", (preview_width, preview_height), color = "white")
 
@@ -678,7 +1440,7 @@ def generate_link_preview(fromLatentProxy: LatentProxy, toLatentProxy: LatentPro
     draw.line([cwGap2-symbolSize, ch - eqH, cwGap2+symbolSize, ch - eqH], width=lineWidth, fill="black")
     draw.line([cwGap2-symbolSize, ch + eqH, cwGap2+symbolSize, ch + eqH], width=lineWidth, fill="black")
 
-    previewIm.save(name, 'JPEG')
+    storeImage(name, previewIm, 'JPEG')
     return name
 
 def get_from_latent(request):
@@ -693,18 +1455,24 @@ def get_to_latent(request):
     toGuidStr = request.args.get('to_guid')
     return useTextOrSeedOrGuid(toTextValue, toSeedStr, toGuidStr)
 
-def ffmpeg_generate_morph_file(filenames, outputFileName, fps=16, kbitrate=2400):    
+def ffmpeg_generate_morph_file(filenames, outputName, fps=16, kbitrate=2400):    
     """
-    Take a series of input image filenames and generates a morph file based on the outputFileName extension.
+    Take a series of input image names in storage and generates a morph file based on the outputName extension,
+    which is put in storage at outputName.
     """
     app.logger.info("ffmpeg_generate_morph_file() --------------------------")
-    with tempfile.NamedTemporaryFile(mode='w+t', delete=False) as concatfile:
-        concatfile.writelines([ f"file '{filename}'\n" for filename in filenames])
+    _, kind = posixpath.splitext(outputName)
+    with storage.localFiles(filenames) as localFilenames, \
+            tempfile.NamedTemporaryFile(suffix=kind, delete=False) as outputFile, \
+            tempfile.NamedTemporaryFile(mode='w+t', delete=False) as concatfile:
+        # closed so ffmpeg can write to it, windows won't let another process open a file that is still open
+        outputFile.close()
+        outputFileName = outputFile.name
+        concatfile.writelines([ f"file '{filename}'\n" for filename in localFilenames])
         concatfile.close()
         try:
             with ffmpegTimeSummary.time():
                 start = time.time()
-                _, kind = os.path.splitext(outputFileName)
                 if kind == ".gif":
                     command = f"ffmpeg -r {str(fps)} -f concat -safe 0 -i \"{concatfile.name}\" -filter_complex \"[0:v] split [a][b];[a] palettegen [p];[b][p] paletteuse\" -y \"{outputFileName}\""
                 elif kind ==".mp4":
@@ -715,15 +1483,26 @@ def ffmpeg_generate_morph_file(filenames, outputFileName, fps=16, kbitrate=2400)
                     raise Exception(f"Unnown kind \"{kind}\" for ffmpeg morph file")
 
                 app.logger.info(command)
-                os.system(command)
+                with timeStage('encode'):
+                    os.system(command)
 
                 diff = time.time() - start
-                app.logger.info(f"Took {diff:.2f} seconds running ffmpeg on {len(filenames)} frames for {outputFileName}")
+                app.logger.info(f"Took {diff:.2f} seconds running ffmpeg on {len(filenames)} frames for {outputName}")
+
+            # ffmpeg rewrites the file at that path, so read it back by name
+            with open(outputFileName, 'rb') as f:
+                data = f.read()
         finally:
             os.unlink(concatfile.name)
-            pass
+            os.unlink(outputFileName)
+        if not data:
+            raise Exception(f"ffmpeg produced no output for {outputName}")
+        with timeStage('write'):
+            storage.put(outputName, data)
+        trackAccess(outputName, len(data))
 
 @app.route('/api/gif/', methods=['GET'])
+@deterministic_response
 def gif_generation():
     fromLatentProxy = get_from_latent(request)
     toLatentProxy = get_to_latent(request)
@@ -733,20 +1512,20 @@ def gif_generation():
     fps = defaultedRequestInt(request, 'fps', 16, 1, 100)
 
     parentMorphdir = getParentMorphdir(fromLatentProxy, toLatentProxy)
-    GIFsDir = os.path.join(parentMorphdir, "GIFs")
-    name = os.path.join(GIFsDir, f"n{num_frames}f{fps}x{image_dim}.gif")
+    GIFsDir = posixpath.join(parentMorphdir, "GIFs")
+    name = posixpath.join(GIFsDir, f"n{num_frames}f{fps}x{image_dim}.gif")
 
-    if not os.path.isfile(name):
-        os.makedirs(GIFsDir, exist_ok=True)
+    if not isGenerated(name, posixpath.splitext(name)[1][1:]):
         framenums = np.arange(num_frames)
         filenames = generate_morph_frames(fromLatentProxy, toLatentProxy, num_frames, image_dim, framenums, isLinear=False)
         ffmpeg_generate_morph_file(filenames, name, fps=fps)
     else:
         app.logger.info(f"GIF file already exists: {name}")
 
-    return send_file(name, mimetype='image/gif')
+    return sendCachedFile(name, 'image/gif')
 
 @app.route('/api/mp4/', methods=['GET'])
+@deterministic_response
 def mp4_generation():
     app.logger.info(f"=========================================================")
     app.logger.info(f"")
@@ -763,14 +1542,13 @@ def mp4_generation():
     kbitrate = defaultedRequestInt(request, 'kbitrate', 2400, 100, 20000)
 
     parentMorphdir = getParentMorphdir(fromLatentProxy, toLatentProxy)
-    mp4sDir = os.path.join(parentMorphdir, "mp4s")
-    name = os.path.join(mp4sDir, f"n{num_frames}f{fps}x{image_dim}k{kbitrate}.mp4")
+    mp4sDir = posixpath.join(parentMorphdir, "mp4s")
+    name = posixpath.join(mp4sDir, f"n{num_frames}f{fps}x{image_dim}k{kbitrate}.mp4")
     app.logger.info(f"parentMorphdir    {parentMorphdir}" )
     app.logger.info(f"mp4sDir           {mp4sDir}")
     app.logger.info(f"name              {name}")
 
-    if not os.path.isfile(name):
-        os.makedirs(mp4sDir, exist_ok=True)
+    if not isGenerated(name, 'mp4'):
         framenums = np.arange(num_frames)
         filenames = generate_morph_frames(fromLatentProxy, toLatentProxy, num_frames, image_dim, framenums, isLinear=False)
         app.logger.info(f"filenames, {filenames}")
@@ -781,21 +1559,26 @@ def mp4_generation():
         app.logger.info(f"MP4 file already exists: {name}")
 
 
+    trackAccess(name)
     embed_html = request.args.get('embed_html')
     if(embed_html):
         embed_html = embed_html.lower()
     if embed_html == 'true':
         srcData = "data:video/mp4;base64,"
-        with open(name, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read())
-            srcData = srcData + encoded_string.decode('utf-8')
+        encoded_string = base64.b64encode(storage.get(name))
+        srcData = srcData + encoded_string.decode('utf-8')
         return render_template('mp4.html', title="Rendered mp4", dim=str(image_dim), src=srcData)
 
 
 
-    return send_file(name, mimetype='video/mp4', conditional=True)
+    localPath = storage.localPath(name)
+    if localPath:
+        # send_file handles range requests, which some video players need
+        return send_file(localPath, mimetype='video/mp4', conditional=True, add_etags=False)
+    return flask.Response(storage.stream(name), mimetype='video/mp4')
 
 @app.route('/api/webp/', methods=['GET'])
+@deterministic_response
 def webp_generation():
     fromLatentProxy = get_from_latent(request)
     toLatentProxy = get_to_latent(request)
@@ -805,20 +1588,20 @@ def webp_generation():
     fps = defaultedRequestInt(request, 'fps', 16, 1, 100)
 
     parentMorphdir = getParentMorphdir(fromLatentProxy, toLatentProxy)
-    webPsDir = os.path.join(parentMorphdir, "webPs")
-    name = os.path.join(webPsDir, f"n{num_frames}f{fps}x{image_dim}.webp")
+    webPsDir = posixpath.join(parentMorphdir, "webPs")
+    name = posixpath.join(webPsDir, f"n{num_frames}f{fps}x{image_dim}.webp")
 
-    if not os.path.isfile(name):
-        os.makedirs(webPsDir, exist_ok=True)
+    if not isGenerated(name, posixpath.splitext(name)[1][1:]):
         framenums = np.arange(num_frames)
         filenames = generate_morph_frames(fromLatentProxy, toLatentProxy, num_frames, image_dim, framenums, isLinear=False)
         ffmpeg_generate_morph_file(filenames, name, fps=fps)
     else:
         app.logger.info(f"WEBP file already exists: {name}")
 
-    return send_file(name, mimetype='image/webp', conditional=True)
+    return sendCachedFile(name, 'image/webp')
 
 @app.route('/api/linkpreview/', methods=['GET'])
+@deterministic_response
 def linkpreview_generation():
     fromLatentProxy = get_from_latent(request)
     toLatentProxy = get_to_latent(request)
@@ -826,9 +1609,10 @@ def linkpreview_generation():
     preview_width = defaultedRequestInt(request, 'width', 1200, 100, 2400)
 
     name = generate_link_preview(fromLatentProxy, toLatentProxy, preview_width)
-    return send_file(name, mimetype='image/jpg')
+    return sendCachedFile(name, 'image/jpg')
 
 @app.route('/api/morphframe/', methods=['GET'])
+@deterministic_response
 def morphframe():
     app.logger.info(f"")
     app.logger.info(f"=========================================================")
@@ -851,7 +1635,7 @@ def morphframe():
     for filename in filenames:
         app.logger.info(f"{filename}")
 
-    return send_file(filenames[0], mimetype='image/jpg')
+    return sendCachedFile(filenames[0], 'image/jpg')
 
 def encodeRequestKey(imgFile, tryAlign: bool):
     # tryAlign not didAlign, because we want to cache against the request not the result,
@@ -862,10 +1646,12 @@ def encodeRequestKey(imgFile, tryAlign: bool):
     return key
 
 def getEncodedImagesRecord(requestKey):
+    countDbRoundTrip()
     return db.encodedimages.find_one({'_id': requestKey})
 
 def setEncodedImagesRecord(requestKey, guid, didAlign):
     app.logger.info(f"Setting encoded image record for {{'guid': '{str(guid)}', 'did_align': {str(didAlign)}}}")
+    countDbRoundTrip()
     db.encodedimages.insert_one({'_id':requestKey, 'guid': guid, 'did_align': didAlign })
 
 @app.route('/api/encodeimage/', methods=['POST'])
@@ -927,48 +1713,248 @@ def encodeimageform():
 
 @app.route('/api/queue/', methods=['GET'])
 def healthcheck():
-    return jsonify({"queue": q.qsize()})
-
+    return jsonify({"queue": q.qsize(),
+                    "classes": {className: q.qsize(priority) for priority, className in jobClassNames.items()}})
 
-def get_batch(batchsize):
-    yield q.get(True) # will block until it gets a job
-    jobQueue.dec(1)
-    for i in range(batchsize-1):
-        if not q.empty():
-            yield q.get_nowait()
-            jobQueue.dec(1)
 
+class BatchPolicy:
+    '''
+    How the worker forms batches: after the first job arrives, it keeps
+    waiting up to maxWaitMs for more jobs until it has targetSize of them.
+    A few ms of latency buys much fuller, so much cheaper, batches at mid-range load.
+    Can be changed while running with a POST to /api/batching/
+    '''
 
-def worker():
-    tf_init_options = None
-    if os.getenv('LOW_GPU_MEM', 'False').lower() in ['true', '1']:
-        tf_init_options = { 'gpu_options.per_process_gpu_memory_fraction': 0.75, 'gpu_options.experimental.use_unified_memory': True }
-    dnnlib.tflib.init_tf(tf_init_options)
-    Gs = fetch_model()
+    def __init__(self, targetSize, maxWaitMs):
+        self.lock = threading.Lock()
+        self.targetSize = targetSize
+        self.maxWaitMs = maxWaitMs
+
+    def get(self):
+        with self.lock:
+            return self.targetSize, self.maxWaitMs
+
+    def update(self, targetSize=None, maxWaitMs=None):
+        with self.lock:
+            if targetSize is not None:
+                self.targetSize = max(1, min(64, int(targetSize)))
+            if maxWaitMs is not None:
+                self.maxWaitMs = max(0.0, min(1000.0, float(maxWaitMs)))
+
+    def asDict(self):
+        targetSize, maxWaitMs = self.get()
+        return {'target_batch_size': targetSize, 'max_wait_ms': maxWaitMs}
+
+batchPolicy = BatchPolicy(int(os.getenv('GENERATOR_BATCH_SIZE', '10')),
+                          float(os.getenv('GENERATOR_BATCH_WAIT_MS', '10')))
+
+@app.route('/api/batching/', methods=['GET'])
+def getBatching():
+    return jsonify(batchPolicy.asDict())
+
+@app.route('/api/batching/', methods=['POST'])
+def setBatching():
+    adminToken = os.getenv('ADMIN_TOKEN')
+    if not adminToken or request.headers.get('Authorization') != f"Bearer {adminToken}":
+        return flask.Response('Not allowed', status=403)
+    try:
+        batchPolicy.update(request.json.get('target_batch_size'), request.json.get('max_wait_ms'))
+    except (TypeError, ValueError, AttributeError):
+        return flask.Response('target_batch_size and max_wait_ms must be numbers', status=400)
+    app.logger.info(f"Batching policy updated to {batchPolicy.asDict()}")
+    return jsonify(batchPolicy.asDict())
+
+
+# running average of generator time per image, to estimate what skipping a job saves
+generatorSecondsPerImage = 0.0
+
+def skip_if_stale(job: GenerateImageJob):
+    if not job.isStale():
+        return False
+    reason = "cancelled" if job.cancelled else "expired"
+    app.logger.info(f"Skipping {reason} job {job}")
+    staleJobsCounter.labels(reason).inc()
+    generatorSecondsSaved.inc(generatorSecondsPerImage)
+    return True
+
+def get_batch(policy: BatchPolicy, timings=None):
+    '''
+    Yields the jobs of the next batch, the seconds spent assembling it are set in timings if given
+    '''
+    timings = {} if timings is None else timings
+    targetSize, maxWaitMs = policy.get()
+    batchSize = 0
+    while batchSize == 0:
+        job = q.get(True) # will block until it gets a job
+        jobQueue.dec(1)
+        if not skip_if_stale(job):
+            job.takenAt = time.time()
+            pipelineStageSeconds.labels('queue_wait', job.endpoint).observe(job.takenAt - job.queuedAt)
+            yield job
+            batchSize += 1
+    start = time.time()
+    deadline = start + maxWaitMs / 1000.0
+    while batchSize < targetSize:
+        try:
+            remaining = deadline - time.time()
+            if remaining > 0:
+                job = q.get(True, remaining)
+            else:
+                job = q.get_nowait()
+        except queue.Empty:
+            break
+        jobQueue.dec(1)
+        if not skip_if_stale(job):
+            job.takenAt = time.time()
+            pipelineStageSeconds.labels('queue_wait', job.endpoint).observe(job.takenAt - job.queuedAt)
+            yield job
+            batchSize += 1
+    timings['assembly'] = time.time() - start
+    batchAssemblySeconds.observe(timings['assembly'])
+
+
+def init_generator(engine=None):
+    '''
+    Loads the generator engine picked by GENERATOR_ENGINE, unless one is given, and warms it up, returns it
+    '''
+    if engine is None:
+        engine = engineFromEnv(num_gpus)
     global dlatent_avg
-    dlatent_avg = Gs.get_var('dlatent_avg')
+    dlatent_avg = engine.dlatent_avg
 
     # Setup for the other bits of the program, hacky and vulnerable to race
     # conditions and might have old data
     global GsInputDim
-    GsInputDim = Gs.input_shape[1]
+    GsInputDim = engine.inputDim
 
-    app.logger.info(f"Warming up generator network with {num_gpus} gpus")
-    warmupNetwork = toImages(Gs, np.array([fromSeed(5)]), None)
+    app.logger.info(f"Warming up {engine.name} generator engine with {num_gpus} gpus")
+    warmupNetwork = toImages(engine, np.array([fromSeed(5)]), None)
     app.logger.info("Generator ready")
+    return engine
 
-    while True:
-        generateImageJobs = list(get_batch(int(os.getenv('GENERATOR_BATCH_SIZE', '10'))))
+def generate_images(engine, latentProxies, timings=None):
+    '''
+    Runs one batch of latents through the generator, returns full size PIL images.
+    Seconds spent in each stage are added to timings if given
+    '''
+    return toImages(engine, generate_dlatents(engine, latentProxies, timings), None, timings)
+
+def generate_dlatents(engine, latentProxies, timings=None):
+    '''
+    Returns the W latents for a batch as an [N, 18, 512] array, from the dlatent cache where possible
+    and mapping the rest in as few runs of the mapping network as possible.
+    Seconds spent in the latent and mapping stages are added to timings if given
+    '''
+    timings = {} if timings is None else timings
+    start = time.time()
+    names = [latentProxy.getName() for latentProxy in latentProxies]
+    dlatents = dlatentCache.getMany([name for name, latentProxy in zip(names, latentProxies) if latentProxy.cacheDLatent])
+    toResolve = {}
+    for name, latentProxy in zip(names, latentProxies):
+        if name not in dlatents:
+            toResolve.setdefault(name, latentProxy)
+    # queued jobs already have theirs, but not latents given to this directly
+    loadGuidLatents(toResolve.values())
+    lerpMappingSeconds = map_lerp_latents(engine, toResolve.values())
+    latents = [latentProxy.getLatent(engine) for latentProxy in toResolve.values()]
+    timings['latent'] = time.time() - start - lerpMappingSeconds
+    start = time.time()
+    resolved = toDLats(engine, latents)
+    timings['mapping'] = time.time() - start + lerpMappingSeconds
+    for (name, latentProxy), latent, dlatent in zip(toResolve.items(), latents, resolved):
+        # W latents that didn't need the mapping network aren't worth keeping
+        if latentProxy.cacheDLatent and np.asarray(latent).shape[0] == 512:
+            dlatentCache.put(name, dlatent)
+        dlatents[name] = dlatent
+    return np.stack([dlatents[name] for name in names])
+
+def map_lerp_latents(engine, latentProxies):
+    '''
+    Maps every Z latent the lerps in latentProxies need as a W latent that isn't in the dlatent cache
+    in one run of the mapping network, rather than one run each as the lerps get their latents.
+    Only the morph endpoints are cached, multilerps map their latents scaled by one-off amounts.
+    Returns the seconds spent
+    '''
+    toMap = {}
+    toCache = set()
+    for latentProxy in latentProxies:
+        latentsToMap = latentProxy.getLatentsToMap()
+        toMap.update(latentsToMap)
+        if latentProxy.cacheLatentsToMap:
+            toCache.update(latentsToMap)
+    if not toMap:
+        return 0.0
+    start = time.time()
+    mapped = dlatentCache.getMany(list(toCache))
+    missing = [name for name in toMap if name not in mapped]
+    if missing:
+        for name, dlatent in zip(missing, toDLats(engine, [toMap[name] for name in missing])):
+            if name in toCache:
+                dlatentCache.put(name, dlatent)
+            mapped[name] = dlatent
+    for latentProxy in latentProxies:
+        latentProxy.setMappedLatents(mapped)
+    return time.time() - start
+
+def toNs(seconds):
+    return int(seconds * 1e9)
+
+def record_batch_spans(jobs, timings, generateStart, finishedAt):
+    '''
+    Traces a batch as its own trace linked to the request of every sampled job in it,
+    with a span for the job in each of those requests' traces linking back to the batch
+    '''
+    links = [job.traceContext for job in jobs]
+    if not any(link.sampled for link in links):
+        return
+    assemblyStart = generateStart - timings.get('assembly', 0)
+    batchSpan = tracer.startSpan('batch', parent=NOOP_SPAN, links=links, sampled=True, startNs=toNs(assemblyStart), attributes={
+        'batch.size': len(jobs), 'endpoints': ",".join(sorted(set(job.endpoint for job in jobs)))})
+    tracer.startSpan('assembly', parent=batchSpan, startNs=toNs(assemblyStart)).end(toNs(generateStart))
+    # the worker's stages run back to back in this order
+    stageStart = generateStart
+    for stage in ('latent', 'mapping', 'synthesis', 'convert'):
+        if stage in timings:
+            tracer.startSpan(stage, parent=batchSpan, startNs=toNs(stageStart)).end(toNs(stageStart + timings[stage]))
+            stageStart += timings[stage]
+    batchSpan.end(toNs(finishedAt))
 
-        latents = np.array([job.latentproxy.getLatent(Gs) for job in generateImageJobs])
+    for job in jobs:
+        if not job.traceContext.sampled:
+            continue
+        jobSpan = tracer.startSpan('generate', parent=job.traceContext, links=[batchSpan.context], startNs=toNs(job.queuedAt),
+                                   attributes={'job': job.name, 'priority': jobClassNames[job.priority], 'batch.size': len(jobs)})
+        tracer.startSpan('queue_wait', parent=jobSpan, startNs=toNs(job.queuedAt)).end(toNs(job.takenAt))
+        jobSpan.end(toNs(finishedAt))
+
+def worker(remoteEngine=None):
+    '''
+    Runs batches from the job queue through the generator, in this process or in remoteEngine's
+    '''
+    if remoteEngine is not None:
+        remoteEngine.waitReady()
+    engine = init_generator(remoteEngine)
+    global generatorSecondsPerImage
+
+    while True:
+        timings = {}
+        generateImageJobs = list(get_batch(batchPolicy, timings))
+        batchSizeHistogram.observe(len(generateImageJobs))
 
         app.logger.info(f"")
         app.logger.info(f"Running jobs {[str(job) for job in generateImageJobs]}")
         app.logger.info(f"")
-        images = toImages(Gs, [toDLat(Gs, lat) for lat in latents], None)
+        start = time.time()
+        images = generate_images(engine, [job.latentproxy for job in generateImageJobs], timings)
+        generatorSecondsPerImage = 0.9 * generatorSecondsPerImage + 0.1 * (time.time() - start) / len(images)
         for img, job in zip(images, generateImageJobs):
             job.set_result(img)
             imagesGenCounter.inc()
+            # every job waits for the whole batch, so each sees the full time of each stage
+            for stage, seconds in timings.items():
+                pipelineStageSeconds.labels(stage, job.endpoint).observe(seconds)
+            jobBatchSize.labels(job.endpoint).observe(len(generateImageJobs))
+        record_batch_spans(generateImageJobs, timings, start, time.time())
 
         app.logger.info(f"")
         app.logger.info(f"=========================")
@@ -978,9 +1964,11 @@ def worker():
 
 
 if __name__ == "__main__":
-    t1 = threading.Thread(target=worker, args=[])
-    t1.daemon = True # kill thread on program termination (to allow keyboard interrupt)
-    t1.start()
+    # the generator processes were started before any threads, at the top
+    for remoteEngine in remoteEngines:
+        t1 = threading.Thread(target=worker, args=[remoteEngine])
+        t1.daemon = True # kill thread on program termination (to allow keyboard interrupt)
+        t1.start()
 
     start_http_server(int(os.getenv('METRICS_PORT', '8000')))
     app.run(host="0.0.0.0", port=os.getenv('API_PORT', '8080'))
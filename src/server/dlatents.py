@@ -0,0 +1,134 @@
+import os
+import zlib
+import threading
+import collections
+
+import numpy as np
+
+# Mapped and truncated W latents are [18, 512] float32, 36 KB each.
+# The disk table is two files, both only ever appended to:
+#   <path>.f32   the latents back to back
+#   <path>.keys  one record per latent, "<byte offset in .f32> <latent name> <crc32 of the rest>\n"
+# A latent is written before its record, each with a single write, so a crash can only leave
+# unreferenced data or a torn last record, which fails its checksum. Records carry their own
+# offsets, so processes sharing a table (the server and prerender.py) don't corrupt it.
+_recordShape = (18, 512)
+_recordBytes = 18 * 512 * 4
+
+
+def _keysRecord(offset, name):
+    body = f"{offset} {name}"
+    return f"{body} {zlib.crc32(body.encode('utf-8')):08x}\n".encode('utf-8')
+
+def _parseKeysRecord(line):
+    '''
+    Returns (offset, name) for a keys record, or None if it is torn or corrupt
+    '''
+    try:
+        body, crc = line.decode('utf-8').rstrip('\n').rsplit(' ', 1)
+        if int(crc, 16) != zlib.crc32(body.encode('utf-8')):
+            return None
+        offset, name = body.split(' ', 1)
+        return int(offset), name
+    except ValueError:
+        return None
+
+
+class DLatentCache:
+    '''
+    W latents by latent name, so the mapping network only runs once for each seed,
+    value or guid however many morphs, link previews and dims it appears in.
+
+    The maxItems most recently used are kept in memory. Given a path, every latent
+    is also added to a table on disk, up to maxDiskBytes, which is read through a
+    memory map and kept across restarts. Latents other processes add to the table
+    are seen next time it is opened.
+
+    results is an optional prometheus counter labelled memory, disk or miss
+    '''
+
+    def __init__(self, maxItems=1000, path=None, maxDiskBytes=None, results=None):
+        self.maxItems = maxItems
+        self.path = path
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.results = results
+        self.offsets = {}
+        self.dataFd = None
+        self.map = None
+        if path:
+            self.maxDiskBytes = maxDiskBytes
+            self._openTable(path)
+
+    def _openTable(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.dataPath = path + '.f32'
+        keysPath = path + '.keys'
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self.dataFd = os.open(self.dataPath, flags, 0o644)
+        self.keysFd = os.open(keysPath, flags, 0o644)
+        dataBytes = os.fstat(self.dataFd).st_size
+        with open(keysPath, 'rb') as f:
+            lines = f.readlines()
+        for line in lines:
+            record = _parseKeysRecord(line)
+            # a record must point at a whole latent in the table
+            if record is not None and record[0] + _recordBytes <= dataBytes:
+                self.offsets[record[1]] = record[0]
+        if lines and not lines[-1].endswith(b'\n'):
+            # ends the torn record left by a crash, so the next one doesn't run on from it
+            os.write(self.keysFd, b'\n')
+
+    def _readRow(self, offset):
+        if self.map is None or offset + _recordBytes > len(self.map):
+            # the table has grown since it was mapped
+            self.map = np.memmap(self.dataPath, dtype=np.uint8, mode='r')
+        return np.frombuffer(self.map[offset : offset + _recordBytes].tobytes(), dtype=np.float32).reshape(_recordShape)
+
+    def _remember(self, name, dlatent):
+        self.items[name] = dlatent
+        self.items.move_to_end(name)
+        while len(self.items) > self.maxItems:
+            self.items.popitem(last=False)
+
+    def _count(self, result, amount=1):
+        if self.results is not None and amount:
+            self.results.labels(result).inc(amount)
+
+    def getMany(self, names):
+        '''
+        Returns {name: dlatent} for the names that are cached
+        '''
+        found = {}
+        fromDisk = 0
+        with self.lock:
+            for name in dict.fromkeys(names):
+                dlatent = self.items.get(name)
+                if dlatent is None and name in self.offsets:
+                    dlatent = self._readRow(self.offsets[name])
+                    fromDisk += 1
+                if dlatent is not None:
+                    self._remember(name, dlatent)
+                    found[name] = dlatent
+        self._count('disk', fromDisk)
+        self._count('memory', len(found) - fromDisk)
+        self._count('miss', len(set(names)) - len(found))
+        return found
+
+    def get(self, name):
+        return self.getMany([name]).get(name)
+
+    def put(self, name, dlatent):
+        dlatent = np.asarray(dlatent, dtype=np.float32).reshape(_recordShape)
+        with self.lock:
+            self._remember(name, dlatent)
+            if self.dataFd is None or name in self.offsets:
+                return
+            if self.maxDiskBytes and os.fstat(self.dataFd).st_size + _recordBytes > self.maxDiskBytes:
+                return
+            # appended wherever the end is now, even if another process has written since
+            if os.write(self.dataFd, dlatent.tobytes()) != _recordBytes:
+                return # out of space, what was written is never referenced
+            offset = os.lseek(self.dataFd, 0, os.SEEK_CUR) - _recordBytes
+            os.write(self.keysFd, _keysRecord(offset, name))
+            self.offsets[name] = offset
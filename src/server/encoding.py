@@ -0,0 +1,105 @@
+import io
+import os
+import time
+import queue
+import multiprocessing
+
+import numpy as np
+import PIL.Image
+
+# Resizing and encoding images with PIL holds the GIL for most of the time it takes,
+# so with many requests at once it throttles everything else the server does.
+# An EncodePool runs it in other processes instead.
+
+
+def encoderSettingsFromEnv():
+    '''
+    PIL save params for each format, from the JPEG_QUALITY, JPEG_PROGRESSIVE, WEBP_QUALITY and WEBP_METHOD environment variables
+    '''
+    return {
+        'JPEG': {'quality': int(os.getenv('JPEG_QUALITY', '75')),
+                 'progressive': os.getenv('JPEG_PROGRESSIVE', 'False').lower() in ['true', '1']},
+        'WEBP': {'quality': int(os.getenv('WEBP_QUALITY', '80')),
+                 'method': int(os.getenv('WEBP_METHOD', '4'))},
+    }
+
+def resizeAndEncode(img, fileFormat, dim=None, **saveParams):
+    '''
+    Returns img resized to dim x dim, unless dim is None or it already is, encoded in fileFormat
+    '''
+    if dim and img.size != (dim, dim):
+        img = img.resize((dim, dim), PIL.Image.ANTIALIAS)
+    buffer = io.BytesIO()
+    img.save(buffer, fileFormat, **saveParams)
+    return buffer.getvalue()
+
+
+_imageBuffer = None
+_slotBytes = None
+
+def _initEncodeProcess(imageBuffer, slotBytes):
+    global _imageBuffer, _slotBytes
+    _imageBuffer = imageBuffer
+    _slotBytes = slotBytes
+
+def _encodeSlot(slot, shape, outputs):
+    '''
+    Runs in the pool, encodes the image in slot of the shared buffer for each (dim, fileFormat, saveParams) in outputs.
+    Returns the encoded images and the seconds it took
+    '''
+    start = time.time()
+    pixels = np.frombuffer(_imageBuffer, dtype=np.uint8, count=int(np.prod(shape)), offset=slot * _slotBytes).reshape(shape)
+    img = PIL.Image.fromarray(pixels, 'RGB')
+    return [resizeAndEncode(img, fileFormat, dim, **saveParams) for dim, fileFormat, saveParams in outputs], time.time() - start
+
+
+class EncodePool:
+    '''
+    Resizes and encodes images in a pool of processes. Each image is copied into one of
+    slots slots of shared memory, where the pool reads it from, so only the encoded bytes
+    are pickled. Images that aren't RGB, or are bigger than maxDim x maxDim, are encoded
+    on the calling thread.
+
+    busySeconds (a Counter) counts the time the processes spend encoding, its rate over
+    the number of processes is the pool's utilization. inFlight (a Gauge) is the number of
+    images being encoded or waiting for a slot
+    '''
+
+    def __init__(self, processes, slots=None, maxDim=1024, busySeconds=None, inFlight=None):
+        self.processes = processes
+        self.slotBytes = maxDim * maxDim * 3
+        slots = slots or 2 * processes
+        self.busySeconds = busySeconds
+        self.inFlight = inFlight
+        self.imageBuffer = multiprocessing.RawArray('B', slots * self.slotBytes)
+        self.freeSlots = queue.Queue()
+        for slot in range(slots):
+            self.freeSlots.put(slot)
+        # forked, as spawning would re-run everything checkface does on import in every process,
+        # so it has to be created before the server starts any threads
+        self.pool = multiprocessing.get_context('fork').Pool(processes, initializer=_initEncodeProcess,
+                                                             initargs=(self.imageBuffer, self.slotBytes))
+
+    def encode(self, img, outputs):
+        '''
+        Returns img encoded for each (dim, fileFormat, saveParams) in outputs, see resizeAndEncode
+        '''
+        if img.mode != 'RGB' or img.size[0] * img.size[1] * 3 > self.slotBytes:
+            return [resizeAndEncode(img, fileFormat, dim, **saveParams) for dim, fileFormat, saveParams in outputs]
+        if self.inFlight:
+            self.inFlight.inc()
+        try:
+            pixels = np.asarray(img)
+            slot = self.freeSlots.get()
+            try:
+                np.frombuffer(self.imageBuffer, dtype=np.uint8, count=pixels.size,
+                              offset=slot * self.slotBytes).reshape(pixels.shape)[...] = pixels
+                encoded, seconds = self.pool.apply(_encodeSlot, (slot, pixels.shape, outputs))
+            finally:
+                self.freeSlots.put(slot)
+        finally:
+            if self.inFlight:
+                self.inFlight.dec()
+        if self.busySeconds:
+            self.busySeconds.inc(seconds)
+        return encoded
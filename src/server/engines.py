@@ -0,0 +1,226 @@
+import os
+import time
+import multiprocessing
+
+import numpy as np
+
+# The generator networks the server can run, picked with GENERATOR_ENGINE.
+# tensorflow is only imported by the engines that need it, so the server and
+# its tools run without it using the synthetic engine.
+
+
+class GeneratorEngine:
+    '''
+    What the server needs from a generator: mapping Z latents to W latents, and synthesizing images from W latents.
+    dlatent_avg is the average W latent, the centre of the truncation trick
+    '''
+    name = None
+    inputDim = 512
+    resolution = 1024
+    dlatent_avg = None
+
+    def map(self, zBatch):
+        '''
+        [N, inputDim] Z latents -> [N, 18, 512] W latents, without truncation
+        '''
+        raise NotImplementedError()
+
+    def synthesize(self, wBatch):
+        '''
+        [N, 18, 512] W latents -> [N, resolution, resolution, 3] uint8 RGB images
+        '''
+        raise NotImplementedError()
+
+
+def fetch_model():
+    network_pkl = 'gdrive:networks/stylegan2-ffhq-config-f.pkl'
+    import pretrained_networks
+    _G, _D, Gs = pretrained_networks.load_networks(network_pkl)
+    return Gs
+
+def _useReferenceOps():
+    '''
+    Makes the network's fused_bias_act and upfirdn_2d ops use their plain tensorflow implementations
+    instead of the custom CUDA kernels, which can't run (or even compile) without a GPU.
+    Has to be called before the network is unpickled, which is when its graph is built
+    '''
+    from dnnlib.tflib.ops import fused_bias_act, upfirdn_2d
+    cudaFusedBiasAct = fused_bias_act.fused_bias_act
+    cudaUpfirdn2d = upfirdn_2d.upfirdn_2d
+    # the network source is executed when unpickled, importing these module attributes,
+    # and the upfirdn_2d helpers look it up from their module on every call
+    fused_bias_act.fused_bias_act = lambda *args, impl='cuda', **kwargs: cudaFusedBiasAct(*args, impl='ref', **kwargs)
+    upfirdn_2d.upfirdn_2d = lambda *args, impl='cuda', **kwargs: cudaUpfirdn2d(*args, impl='ref', **kwargs)
+
+
+class TFEngine(GeneratorEngine):
+    '''
+    The StyleGAN2 FFHQ network in tensorflow, on numGpus GPUs, or on the CPU with the reference ops
+    '''
+
+    def __init__(self, numGpus=1, cpu=False, tfInitOptions=None, minibatchSize=20):
+        self.name = 'tf-cpu' if cpu else 'tf'
+        tfInitOptions = dict(tfInitOptions or {})
+        if cpu:
+            _useReferenceOps()
+            tfInitOptions.update({'env.CUDA_VISIBLE_DEVICES': '-1', 'allow_soft_placement': True})
+            numGpus = 1 # the network runs on "/gpu:0", soft placement moves it to the cpu
+        import dnnlib.tflib as tflib
+        tflib.init_tf(tfInitOptions)
+        self.Gs = fetch_model()
+        self.inputDim = self.Gs.input_shape[1]
+        self.dlatent_avg = self.Gs.get_var('dlatent_avg')
+        self.synthesisKwargs = dict(output_transform=dict(
+            func=tflib.convert_images_to_uint8, nchw_to_nhwc=True), minibatch_size=minibatchSize, num_gpus=numGpus)
+
+    def map(self, zBatch):
+        return self.Gs.components.mapping.run(zBatch, None)
+
+    def synthesize(self, wBatch):
+        return self.Gs.components.synthesis.run(wBatch, randomize_noise=False, structure='linear', **self.synthesisKwargs)
+
+
+class SyntheticEngine(GeneratorEngine):
+    '''
+    Stands in for the network without tensorflow, the model or a GPU,
+    so the server can be benchmarked and tested on any machine.
+
+    Images are a cheap deterministic function of the latent, blocks of colour
+    rather than faces, and each synthesis run sleeps for batchSeconds plus
+    imageSeconds per image to roughly mimic how GPU time grows with batch size
+    '''
+    name = 'synthetic'
+
+    def __init__(self, resolution=1024, batchSeconds=0.05, imageSeconds=0.02, seed=0):
+        self.resolution = resolution
+        self.batchSeconds = batchSeconds
+        self.imageSeconds = imageSeconds
+        self.dlatent_avg = np.zeros(512, dtype=np.float32)
+        self.mappingWeights = np.random.RandomState(seed).randn(512, 512).astype(np.float32) / np.sqrt(512)
+
+    def map(self, zBatch):
+        dlatent = np.tanh(np.asarray(zBatch, dtype=np.float32) @ self.mappingWeights)
+        return np.repeat(dlatent[:, np.newaxis, :], 18, axis=1)
+
+    def synthesize(self, wBatch):
+        wBatch = np.asarray(wBatch, dtype=np.float32)
+        time.sleep(self.batchSeconds + self.imageSeconds * len(wBatch))
+        # a 4x4 grid of colours from the first 48 values of the first layer
+        colours = ((np.tanh(wBatch[:, 0, :48]) + 1) * 127.5).astype(np.uint8).reshape(-1, 4, 4, 3)
+        blockSize = self.resolution // 4
+        return np.repeat(np.repeat(colours, blockSize, axis=1), blockSize, axis=2)
+
+
+def engineNameFromEnv():
+    return os.getenv('GENERATOR_ENGINE', 'tf').lower()
+
+def engineFromEnv(numGpus):
+    '''
+    Builds the GeneratorEngine picked by GENERATOR_ENGINE: tf (default), tf-cpu or synthetic
+    '''
+    engine = engineNameFromEnv()
+    if engine == 'synthetic':
+        return SyntheticEngine(batchSeconds=float(os.getenv('SYNTHETIC_BATCH_SECONDS', '0.05')),
+                               imageSeconds=float(os.getenv('SYNTHETIC_IMAGE_SECONDS', '0.02')))
+    if engine in ('tf', 'tf-cpu'):
+        tfInitOptions = None
+        if os.getenv('LOW_GPU_MEM', 'False').lower() in ['true', '1']:
+            tfInitOptions = { 'gpu_options.per_process_gpu_memory_fraction': 0.75, 'gpu_options.experimental.use_unified_memory': True }
+        return TFEngine(numGpus, cpu=engine == 'tf-cpu', tfInitOptions=tfInitOptions)
+    raise ValueError(f"Unknown GENERATOR_ENGINE {engine}, expected tf, tf-cpu or synthetic")
+
+
+def _engineProcess(conn, imageBuffer, slots, env):
+    '''
+    Runs in each engine process: builds the engine, then serves map and synthesize requests
+    from the parent, writing synthesized images into the shared imageBuffer
+    '''
+    os.environ.update(env)
+    try:
+        engine = engineFromEnv(1)
+        images = np.frombuffer(imageBuffer, dtype=np.uint8).reshape(slots, engine.resolution, engine.resolution, 3)
+        conn.send(('ok', (engine.name, engine.inputDim, engine.dlatent_avg)))
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+    while True:
+        try:
+            op, batch = conn.recv()
+        except EOFError:
+            return # the server has exited
+        try:
+            if op == 'map':
+                conn.send(('ok', engine.map(batch)))
+            else:
+                images[:len(batch)] = engine.synthesize(batch)
+                conn.send(('ok', len(batch)))
+        except Exception as e:
+            conn.send(('error', repr(e)))
+
+
+class RemoteEngine(GeneratorEngine):
+    '''
+    Runs an engine in its own process, so inference doesn't share the GIL with request handling
+    and several model replicas can run at once. Latents go over a pipe, they are small, but the
+    images come back through a shared memory buffer of slots images, without pickling or copying.
+
+    The array synthesize returns is a view of that buffer, only valid until the next call,
+    so each RemoteEngine must only be used by one thread
+    '''
+
+    def __init__(self, replica, slots, env=None):
+        self.replica = replica
+        self.slots = slots
+        imageBytes = self.resolution * self.resolution * 3
+        self.imageBuffer = multiprocessing.RawArray('B', slots * imageBytes)
+        self.images = np.frombuffer(self.imageBuffer, dtype=np.uint8).reshape(slots, self.resolution, self.resolution, 3)
+        # forked, as spawning would re-run everything checkface does on import in every process,
+        # so they have to be started before the server starts any threads
+        context = multiprocessing.get_context('fork')
+        self.conn, childConn = context.Pipe()
+        self.process = context.Process(target=_engineProcess, args=(childConn, self.imageBuffer, slots, env or {}),
+                                       name=f"engine-{replica}", daemon=True)
+        self.process.start()
+        childConn.close()
+
+    def _receive(self):
+        try:
+            status, result = self.conn.recv()
+        except EOFError:
+            self.process.join(1)
+            raise RuntimeError(f"Generator engine process {self.replica} exited with code {self.process.exitcode}")
+        if status == 'error':
+            raise RuntimeError(f"Generator engine process {self.replica} failed: {result}")
+        return result
+
+    def _call(self, op, batch):
+        self.conn.send((op, batch))
+        return self._receive()
+
+    def waitReady(self):
+        '''
+        Blocks until the engine process has loaded its engine
+        '''
+        name, self.inputDim, self.dlatent_avg = self._receive()
+        self.name = f"{name} process {self.replica}"
+
+    def map(self, zBatch):
+        return self._call('map', np.asarray(zBatch))
+
+    def synthesize(self, wBatch):
+        wBatch = np.asarray(wBatch)
+        if len(wBatch) <= self.slots:
+            return self.images[:self._call('synthesize', wBatch)]
+        # more than fits in the buffer at once, copy it out a chunk at a time
+        return np.concatenate([self.synthesize(wBatch[start : start + self.slots]).copy()
+                               for start in range(0, len(wBatch), self.slots)])
+
+
+def startEngineProcesses(count, slots):
+    '''
+    Starts count engine processes of the GENERATOR_ENGINE engine, returns a RemoteEngine for each.
+    With the tf engine each uses one GPU, process i gets GPU i
+    '''
+    gpuPerProcess = engineNameFromEnv() == 'tf'
+    return [RemoteEngine(replica, slots, {'CUDA_VISIBLE_DEVICES': str(replica)} if gpuPerProcess else {})
+            for replica in range(count)]
@@ -0,0 +1,90 @@
+import os
+import threading
+import collections
+
+import numpy as np
+from bson.binary import Binary
+
+# Registered latents are stored in the latents collection as
+#   {'_id': guid, 'type': 'qlatent' or 'dlatent', 'latent': <raw little endian bytes>, 'dtype': 'float32', 'shape': [18, 512]}
+# Older records have 'latent' as a (nested) list of doubles instead, which is about 6x the size
+# and much slower to decode. Both are read, migrate_latents.py converts old records to binary.
+storageDtypes = ('float32', 'float16')
+
+# the fields decodeLatent needs, for fetching records without anything else that's been added to them
+recordProjection = {'type': 1, 'latent': 1, 'dtype': 1, 'shape': 1}
+
+
+def latentStorageDtypeFromEnv():
+    '''
+    The dtype new latents are stored as, from the LATENT_STORAGE_DTYPE environment variable
+    '''
+    dtype = os.getenv('LATENT_STORAGE_DTYPE', 'float32').lower()
+    if dtype not in storageDtypes:
+        raise ValueError(f"Unknown LATENT_STORAGE_DTYPE {dtype}, expected {' or '.join(storageDtypes)}")
+    return dtype
+
+def _littleEndian(dtype):
+    return np.dtype(dtype).newbyteorder('<')
+
+def encodeLatent(latent, dtype='float32'):
+    '''
+    The fields storing latent in a latents record, as dtype
+    '''
+    latent = np.ascontiguousarray(latent, dtype=_littleEndian(dtype))
+    return {'latent': Binary(latent.tobytes()), 'dtype': dtype, 'shape': list(latent.shape)}
+
+def isBinaryRecord(record):
+    return isinstance(record['latent'], bytes)
+
+def decodeLatent(record):
+    '''
+    The latent of a latents record in either format, as a float32 array.
+    float32 records are read straight from the record's bytes without copying, so the array is read only
+    '''
+    if not isBinaryRecord(record):
+        return np.array(record['latent'])
+    latent = np.frombuffer(record['latent'], dtype=_littleEndian(record['dtype'])).reshape(record['shape'])
+    if latent.dtype != np.float32:
+        latent = latent.astype(np.float32)
+    return latent
+
+
+class GuidLatentCache:
+    '''
+    The maxItems most recently used registered latents by guid, so faces and morphs of the same
+    guids don't query the database every time. Registered latents never change, so are never stale.
+
+    Latents are made read only, as they are shared between requests.
+    results is an optional prometheus counter labelled hit or miss
+    '''
+
+    def __init__(self, maxItems=1000, results=None):
+        self.maxItems = maxItems
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.results = results
+
+    def getMany(self, guids):
+        '''
+        Returns {guid: latent} for the guids that are cached
+        '''
+        found = {}
+        with self.lock:
+            for guid in guids:
+                latent = self.items.get(guid)
+                if latent is not None:
+                    self.items.move_to_end(guid)
+                    found[guid] = latent
+        if self.results is not None:
+            self.results.labels('hit').inc(len(found))
+            self.results.labels('miss').inc(len(guids) - len(found))
+        return found
+
+    def put(self, guid, latent):
+        latent.flags.writeable = False
+        with self.lock:
+            self.items[guid] = latent
+            self.items.move_to_end(guid)
+            while len(self.items) > self.maxItems:
+                self.items.popitem(last=False)
@@ -0,0 +1,321 @@
+import os
+import mmap
+import glob
+import struct
+import logging
+import threading
+import time
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Each segment is a pair of files in the pack dir:
+#   000001.pack  the stored data, appended back to back
+#   000001.idx   one record per put, an _indexRecord header followed by the utf-8 key
+# Later records win over earlier ones, and later segments over earlier segments,
+# so the index can be rebuilt by reading every .idx in order.
+# A record with length _deleted is a tombstone, removing the key from earlier segments.
+_indexRecord = struct.Struct('<QIH') # offset, length, key length
+_deleted = 0xFFFFFFFF
+
+
+class PackDirLocked(RuntimeError):
+    '''
+    Raised when opening a pack dir another process already has open
+    '''
+
+
+def _lockDir(root):
+    '''
+    Takes an exclusive lock on root's LOCK file, held until the returned file is closed or the process exits.
+    Each process only knows where its own appends end, so two writing to one pack dir would corrupt it
+    '''
+    lockFile = open(os.path.join(root, "LOCK"), 'a+b')
+    try:
+        try:
+            import fcntl
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            import msvcrt
+            lockFile.seek(0)
+            msvcrt.locking(lockFile.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lockFile.close()
+        raise PackDirLocked(f"Pack dir {root} is in use by another process, such as a running server. "
+                            "Only one process may use a pack dir at a time")
+    return lockFile
+
+
+class _Segment:
+    '''
+    Only the active segment has its files open for appending, sealed ones are only read through their mmap,
+    so a large store doesn't hold two file descriptors per segment
+    '''
+
+    def __init__(self, root, segmentId, active=False):
+        self.id = segmentId
+        self.dataPath = os.path.join(root, f"{segmentId:06d}.pack")
+        self.indexPath = os.path.join(root, f"{segmentId:06d}.idx")
+        self.dataFile = None
+        self.indexFile = None
+        if active:
+            self.dataFile = open(self.dataPath, 'ab', buffering=0)
+            self.indexFile = open(self.indexPath, 'ab', buffering=0)
+        self.size = os.path.getsize(self.dataPath)
+        self.liveBytes = 0
+        self.map = None
+
+    def seal(self):
+        '''
+        Makes the segment read only once it is no longer the active one, syncing what was appended to it
+        '''
+        if self.dataFile is not None:
+            self.sync()
+            self.dataFile.close()
+            self.indexFile.close()
+            self.dataFile = self.indexFile = None
+
+    def readIndex(self):
+        '''
+        Yields (key, offset, length) for every record, dropping a torn record left at the end by a crash.
+        length is _deleted for tombstones
+        '''
+        validBytes = 0
+        if os.path.getsize(self.indexPath):
+            with open(self.indexPath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as indexMap:
+                pos = 0
+                while pos + _indexRecord.size <= len(indexMap):
+                    offset, length, keyLength = _indexRecord.unpack_from(indexMap, pos)
+                    keyEnd = pos + _indexRecord.size + keyLength
+                    if keyEnd > len(indexMap) or (length != _deleted and offset + length > self.size):
+                        break
+                    yield indexMap[pos + _indexRecord.size : keyEnd].decode('utf-8'), offset, length
+                    pos = validBytes = keyEnd
+        if validBytes != os.path.getsize(self.indexPath) and self.indexFile is not None:
+            # only the active segment is appended to, so only it can have been torn by a crash
+            self.indexFile.truncate(validBytes)
+
+    def appendTombstone(self, key):
+        keyBytes = key.encode('utf-8')
+        self.indexFile.write(_indexRecord.pack(0, _deleted, len(keyBytes)) + keyBytes)
+
+    def append(self, key, data):
+        offset = self.size
+        self.dataFile.write(data)
+        self.size += len(data)
+        # the data is written before its index record, so a crash can only leave unreferenced data
+        keyBytes = key.encode('utf-8')
+        self.indexFile.write(_indexRecord.pack(offset, len(data), len(keyBytes)) + keyBytes)
+        return offset
+
+    def view(self, offset, length):
+        if length == 0:
+            return memoryview(b'')
+        if self.map is None or offset + length > len(self.map):
+            # the file has grown since it was mapped, readers holding the old map keep using it
+            with open(self.dataPath, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.map)[offset : offset + length]
+
+    def sync(self):
+        '''
+        Flushes the segment to disk, data first so a synced index record never points at unsynced data.
+        Sealed segments were synced when they were sealed
+        '''
+        if self.dataFile is not None:
+            os.fsync(self.dataFile.fileno())
+            os.fsync(self.indexFile.fileno())
+
+    def close(self):
+        if self.dataFile is not None:
+            self.dataFile.close()
+            self.indexFile.close()
+
+
+class PackStorage(Storage):
+    '''
+    Appends everything to a few large segment files instead of one file per key,
+    for when millions of small images would exhaust the inodes of the volume or
+    make backups crawl. The key -> (segment, offset, length) index is kept in memory,
+    rebuilt from the segment index files on start, and reads are served from mmaps
+    of the segments.
+
+    Segments whose data is mostly overwritten or deleted are compacted in the
+    background, by copying what is still live into the current segment.
+    Only one process may use a pack dir at a time, opening one that is already
+    open raises PackDirLocked.
+    '''
+
+    def __init__(self, root, segmentBytes=256 * 1024 * 1024, compactGarbageRatio=0.5, compactIntervalSeconds=60):
+        self.root = root
+        self.segmentBytes = segmentBytes
+        self.compactGarbageRatio = compactGarbageRatio
+        self.lock = threading.RLock()
+        self.index = {}
+        self.segments = {}
+        os.makedirs(root, exist_ok=True)
+        self.lockFile = _lockDir(root)
+
+        # left behind by a compaction that couldn't remove them, or a crash while creating a segment
+        for dataPath in glob.glob(os.path.join(root, "*.pack")):
+            if not os.path.exists(dataPath[:-len(".pack")] + ".idx"):
+                try:
+                    os.unlink(dataPath)
+                except OSError:
+                    pass
+        indexPaths = sorted(glob.glob(os.path.join(root, "*.idx")))
+        for indexPath in indexPaths:
+            segment = _Segment(root, int(os.path.basename(indexPath).split('.')[0]), active=indexPath == indexPaths[-1])
+            self.segments[segment.id] = segment
+            for key, offset, length in segment.readIndex():
+                if length == _deleted:
+                    self._removeEntry(key)
+                else:
+                    self._setEntry(key, segment, offset, length)
+        if not self.segments:
+            self._newSegment()
+        self.active = self.segments[max(self.segments)]
+
+        if compactIntervalSeconds:
+            threading.Thread(target=self._compactLoop, args=(compactIntervalSeconds,), daemon=True).start()
+
+    def close(self):
+        '''
+        Closes the segments and releases the pack dir for other processes
+        '''
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.lockFile.close()
+
+    def _newSegment(self):
+        segment = _Segment(self.root, max(self.segments, default=0) + 1, active=True)
+        if self.segments:
+            self.active.seal()
+        self.segments[segment.id] = segment
+        self.active = segment
+        return segment
+
+    def _setEntry(self, key, segment, offset, length):
+        previous = self.index.get(key)
+        if previous is not None:
+            previous[0].liveBytes -= previous[2]
+        self.index[key] = (segment, offset, length)
+        segment.liveBytes += length
+
+    def _removeEntry(self, key):
+        previous = self.index.pop(key, None)
+        if previous is not None:
+            previous[0].liveBytes -= previous[2]
+        return previous
+
+    def exists(self, key):
+        return key in self.index
+
+    def existsMany(self, keys):
+        return [key in self.index for key in keys]
+
+    def view(self, key):
+        '''
+        Returns a memoryview of the stored data straight out of the segment mmap, without copying it, or None
+        '''
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            segment, offset, length = entry
+            return segment.view(offset, length)
+
+    def get(self, key):
+        view = self.view(key)
+        # a single copy out of the page cache, no file is opened or read
+        return None if view is None else view.tobytes()
+
+    def put(self, key, data):
+        with self.lock:
+            if self.active.size >= self.segmentBytes:
+                self._newSegment()
+            offset = self.active.append(key, data)
+            self._setEntry(key, self.active, offset, len(data))
+
+    def delete(self, key):
+        with self.lock:
+            if self._removeEntry(key) is not None:
+                self.active.appendTombstone(key)
+
+    def scan(self, prefix):
+        prefix = prefix + "/"
+        with self.lock:
+            entries = [(key, segment, length) for key, (segment, _, length) in self.index.items() if key.startswith(prefix)]
+        # there are no per key times, the segment's is the latest any of its keys could have been written
+        mtimes = {}
+        for key, segment, length in entries:
+            if segment.id not in mtimes:
+                mtimes[segment.id] = os.path.getmtime(segment.dataPath)
+            yield key, length, mtimes[segment.id]
+
+    def stream(self, key, chunkSize=1024 * 1024):
+        view = self.view(key)
+        if view is None:
+            raise KeyError(key)
+        for i in range(0, len(view), chunkSize):
+            yield view[i : i + chunkSize].tobytes()
+
+    def compact(self):
+        '''
+        Rewrites the live data of sealed segments that are mostly garbage into the active segment
+        and removes them, returns how many bytes were reclaimed.
+        The data is copied without holding the lock, which is only taken to append each copy
+        and swap its index entry, so reads and writes carry on while a segment is compacted
+        '''
+        reclaimed = 0
+        for segment in list(self.segments.values()):
+            if segment is self.active or segment.size == 0:
+                continue
+            if segment.liveBytes > segment.size * (1 - self.compactGarbageRatio):
+                continue
+            reclaimed += segment.size - segment.liveBytes
+            with self.lock:
+                entries = [(key, offset, length) for key, (entrySegment, offset, length) in self.index.items()
+                           if entrySegment is segment]
+            written = set()
+            for key, offset, length in entries:
+                # sealed, so its data can be read without the lock
+                data = segment.view(offset, length).tobytes()
+                with self.lock:
+                    if self.index.get(key) != (segment, offset, length):
+                        continue # overwritten or deleted since
+                    if self.active.size >= self.segmentBytes:
+                        self._newSegment()
+                    self._setEntry(key, self.active, self.active.append(key, data), length)
+                    written.add(self.active)
+            # keep tombstones that still hide data in older segments
+            tombstones = [key for key, _, length in segment.readIndex() if length == _deleted]
+            with self.lock:
+                if min(self.segments) < segment.id:
+                    for key in tombstones:
+                        if key not in self.index:
+                            self.active.appendTombstone(key)
+                            written.add(self.active)
+                del self.segments[segment.id]
+            # the copies must be on disk before the only other copy is removed
+            for writtenSegment in written:
+                writtenSegment.sync()
+            segment.close()
+            # the index goes first, so a crash part way can't bring back stale entries.
+            # readers still holding the old mmap keep reading it after the unlink
+            os.unlink(segment.indexPath)
+            try:
+                os.unlink(segment.dataPath)
+            except OSError:
+                pass # still mapped on windows, without its index it is never read again
+        return reclaimed
+
+    def _compactLoop(self, intervalSeconds):
+        while True:
+            time.sleep(intervalSeconds)
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Pack compaction failed")
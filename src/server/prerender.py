@@ -0,0 +1,207 @@
+"""Render faces and morph frames straight into storage, without going through the api.
+
+Reads one request per line, written as the query string the api would take,
+and writes the same files the api would, so they are cache hits from then on.
+Work is sorted into full generator batches, anything that already exists is
+skipped, so an interrupted run can just be started again.
+"""
+
+import argparse
+import os
+import sys
+import time
+import urllib.parse
+
+from werkzeug.datastructures import MultiDict
+
+from packstore import PackDirLocked
+try:
+    import checkface as cf
+except PackDirLocked as e:
+    sys.exit(f'{e}. Stop the server before prerendering into a pack dir.')
+
+#----------------------------------------------------------------------------
+
+class SpecRequest:
+    '''
+    Just enough of a flask request for checkface to parse the args of a spec line
+    '''
+    def __init__(self, line):
+        self.args = MultiDict(urllib.parse.parse_qsl(line, keep_blank_values=True))
+
+    def isMorph(self):
+        return any(key.startswith('from_') or key.startswith('to_') for key in self.args)
+
+class RenderItem:
+    '''
+    One latent to generate, and every file to write from it
+    '''
+    def __init__(self, latentProxy, isFace):
+        self.latentProxy = latentProxy
+        self.isFace = isFace
+        self.outputs = {}
+
+    def addOutput(self, name, image_dim, fileFormat):
+        self.outputs[name] = (image_dim, fileFormat)
+
+    def save(self, img):
+        if self.isFace:
+            # prerendering is as fast as the writes can keep up with, so none are dropped
+            cf.saveMasterImage(self.latentProxy, img, background=False)
+        cf.storeImages(img, [(name, fileFormat, image_dim) for name, (image_dim, fileFormat) in self.outputs.items()])
+
+#----------------------------------------------------------------------------
+
+def spec_outputs(lines, default_dims):
+    '''
+    Yields (latentProxy, isFace, name, image_dim, fileFormat) for every file the spec lines ask for
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        request = SpecRequest(line)
+        dims = [cf.getRequestedImageDim(request)] if 'dim' in request.args else default_dims
+
+        if request.isMorph():
+            fromLatentProxy = cf.get_from_latent(request)
+            toLatentProxy = cf.get_to_latent(request)
+            num_frames = cf.defaultedRequestInt(request, 'num_frames', 50, 3, 200)
+            isLinear = cf.argIsTrue(request, 'linear')
+            vals = cf.getMorphAmounts(num_frames, isLinear)
+            parentMorphdir = cf.getParentMorphdir(fromLatentProxy, toLatentProxy)
+            for image_dim in dims:
+                framesdir = cf.getFramesMorphdir(parentMorphdir, num_frames, image_dim, isLinear)
+                for i, fName in cf.getMorphFrameFiles(framesdir, num_frames, range(num_frames), isLinear):
+                    lerpLatentProxy = cf.LatentByLerp(fromLatentProxy, toLatentProxy, 1 - vals[i])
+                    yield lerpLatentProxy, False, fName, image_dim, 'JPEG'
+        else:
+            latentProxy = cf.getRequestLatent(request)
+            isWebp = cf.getRequestedFormat(request) == "webp"
+            for image_dim in dims:
+                name, fileFormat, _ = cf.getFaceImageFile(latentProxy, image_dim, isWebp)
+                yield latentProxy, True, name, image_dim, fileFormat
+
+def plan_items(lines, default_dims):
+    '''
+    Returns the RenderItems still to do for the spec lines, keyed by latent name
+    '''
+    outputs = list(spec_outputs(lines, default_dims))
+
+    # one bulk existence check, which matters when storage is remote
+    items = {}
+    skipped = 0
+    stored = cf.storage.existsMany([name for _, _, name, _, _ in outputs])
+    for (latentProxy, isFace, name, image_dim, fileFormat), isStored in zip(outputs, stored):
+        if isStored:
+            skipped += 1
+            continue
+        item = items.setdefault(latentProxy.getName(), RenderItem(latentProxy, isFace))
+        item.addOutput(name, image_dim, fileFormat)
+    return items, skipped
+
+def derive_from_masters(items):
+    '''
+    Writes the faces that already have a master without using the generator,
+    returns the items that still need rendering
+    '''
+    toRender = []
+    for item in items:
+        img = cf.loadMasterImage(item.latentProxy) if item.isFace else None
+        if img is None:
+            toRender.append(item)
+        else:
+            item.save(img)
+    return toRender
+
+def prerender(lines, default_dims, batch_size):
+    items, skipped = plan_items(lines, default_dims)
+    print(f'Skipping {skipped} files that already exist')
+    toRender = derive_from_masters(items.values())
+    print(f'Derived {len(items) - len(toRender)} faces from existing masters')
+    print(f'Rendering {len(toRender)} images in batches of {batch_size}...')
+    if not toRender:
+        return
+
+    engine = cf.init_generator()
+    start = time.time()
+    for batchStart in range(0, len(toRender), batch_size):
+        batch = toRender[batchStart : batchStart + batch_size]
+        images = cf.generate_images(engine, [item.latentProxy for item in batch])
+        for item, img in zip(batch, images):
+            item.save(img)
+        done = batchStart + len(batch)
+        diff = time.time() - start
+        print(f'Rendered {done}/{len(toRender)} images, {done / diff:.2f} images/sec')
+
+def prewarm_dlatents(lines, batch_size):
+    '''
+    Maps the latents of the spec lines into the dlatent cache's table on disk, without rendering anything.
+    The mapping network is cheap, so this is a quick way to take it out of rendering popular faces.
+    Morph frames are skipped, as their latents aren't cached
+    '''
+    latentProxies = {}
+    for latentProxy, *_ in spec_outputs(lines, [cf.default_image_dim]):
+        if latentProxy.cacheDLatent:
+            latentProxies.setdefault(latentProxy.getName(), latentProxy)
+    latentProxies = list(latentProxies.values())
+    print(f'Mapping {len(latentProxies)} latents into {cf.dlatentCache.path} in batches of {batch_size}...')
+
+    engine = cf.init_generator()
+    start = time.time()
+    for batchStart in range(0, len(latentProxies), batch_size):
+        cf.generate_dlatents(engine, latentProxies[batchStart : batchStart + batch_size])
+    print(f'Done in {time.time() - start:.1f}s')
+
+#----------------------------------------------------------------------------
+
+_examples = '''examples:
+
+  # Pre-render a list of release checksums at the default dims
+  python %(prog)s checksums.txt
+
+  # Faces and morphs can be mixed, one api query string per line, eg.
+  #   value=5d41402abc4b2a76b9719d911017c592&format=webp
+  #   seed=42&dim=1024
+  #   from_value=abc&to_seed=42&num_frames=50&dim=400
+  git log --format=value=%%H -n 1000 | python %(prog)s --dims=100,300 -
+
+  # Only map the latents, so later renders of them just need synthesis
+  DLATENT_CACHE_DISK_MB=1024 python %(prog)s --dlatents-only --batch-size=500 checksums.txt
+'''
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='''Render faces and morph frames into storage in full generator batches, bypassing the api.
+Run from the same working directory as checkface.py.''',
+        epilog=_examples,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('specs', help='File with one api query string per line, or - for stdin')
+    parser.add_argument('--dims', help='Comma separated dims to render lines without a dim param at (default: %(default)s)',
+                        default=str(cf.default_image_dim))
+    parser.add_argument('--batch-size', help='Images per generator batch (default: %(default)s)', type=int,
+                        default=int(os.getenv('GENERATOR_BATCH_SIZE', '10')))
+    parser.add_argument('--dlatents-only', help="Map the latents into the dlatent cache on disk (see DLATENT_CACHE_DISK_MB) instead of rendering",
+                        action='store_true')
+    args = parser.parse_args()
+
+    default_dims = [int(dim) for dim in args.dims.split(',')]
+    if args.specs == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.specs) as f:
+            lines = f.readlines()
+    if args.dlatents_only:
+        if not cf.dlatentCache.path:
+            sys.exit('Set DLATENT_CACHE_DISK_MB to keep the mapped latents on disk')
+        prewarm_dlatents(lines, args.batch_size)
+    else:
+        prerender(lines, default_dims, args.batch_size)
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,96 @@
+import threading
+import collections
+import queue
+import time
+
+
+class PriorityJobQueue:
+    '''
+    A drop in replacement for queue.Queue of jobs that have a priority class.
+
+    Jobs within a class are FIFO. Across classes, jobs are taken by smooth
+    weighted round robin, so every class with queued work gets a share of each
+    batch in proportion to its weight, and a big burst of low priority jobs
+    can't hold up interactive ones for long. On top of that, jobs that have
+    waited longer than starvationSeconds are aged: every other take goes to the
+    oldest such job regardless of class, so a low weight class can't be starved
+    by a constant stream of higher priority work, while the other half of the
+    worker still follows the weights rather than degenerating into plain FIFO.
+
+    weights maps each priority class to its share, ties go to the class listed
+    first. Jobs must have a priority attribute.
+    '''
+
+    def __init__(self, weights, starvationSeconds=5.0):
+        self.weights = dict(weights)
+        self.starvationSeconds = starvationSeconds
+        self.queues = {priority: collections.deque() for priority in self.weights}
+        self.currentWeights = {priority: 0 for priority in self.weights}
+        self.size = 0
+        self.lastWasStarved = False
+        self.notEmpty = threading.Condition(threading.Lock())
+
+    def put(self, job, block=True, timeout=None):
+        with self.notEmpty:
+            self.queues[job.priority].append((time.time(), job))
+            self.size += 1
+            self.notEmpty.notify()
+
+    def put_nowait(self, job):
+        self.put(job, False)
+
+    def get(self, block=True, timeout=None):
+        with self.notEmpty:
+            if not block:
+                if not self.size:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.size:
+                    self.notEmpty.wait()
+            else:
+                endtime = time.time() + timeout
+                while not self.size:
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    self.notEmpty.wait(remaining)
+            return self._take()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self, priority=None):
+        with self.notEmpty:
+            if priority is None:
+                return self.size
+            return len(self.queues[priority])
+
+    def empty(self):
+        return not self.qsize()
+
+    def _take(self):
+        priority = None if self.lastWasStarved else self._starvedClass()
+        self.lastWasStarved = priority is not None
+        if priority is None:
+            priority = self._nextByWeight()
+        _, job = self.queues[priority].popleft()
+        self.size -= 1
+        return job
+
+    def _starvedClass(self):
+        oldestTime, oldestClass = time.time() - self.starvationSeconds, None
+        for priority, jobs in self.queues.items():
+            if jobs and jobs[0][0] < oldestTime:
+                oldestTime, oldestClass = jobs[0][0], priority
+        return oldestClass
+
+    def _nextByWeight(self):
+        # nginx style smooth weighted round robin, only over classes with queued jobs
+        ready = [priority for priority, jobs in self.queues.items() if jobs]
+        totalWeight = 0
+        for priority in ready:
+            self.currentWeights[priority] += self.weights[priority]
+            totalWeight += self.weights[priority]
+        chosen = max(ready, key=lambda priority: self.currentWeights[priority])
+        self.currentWeights[chosen] -= totalWeight
+        return chosen
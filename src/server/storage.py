@@ -0,0 +1,463 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import logging
+import contextlib
+import concurrent.futures
+
+from caches import BloomFilter
+
+logger = logging.getLogger(__name__)
+
+# Keys are relative posix style paths such as
+# "outputImages/hash-ba/78/hash-ba78..._300.jpg", the same layout as the local checkfacedata dir
+
+
+class Storage:
+    '''
+    This is an Abstract Base Class for where generated images and morphs are kept
+    '''
+
+    def exists(self, key):
+        raise NotImplementedError()
+
+    def existsMany(self, keys):
+        '''
+        Returns a list of whether each key exists, backends override this when they can do it in bulk
+        '''
+        return [self.exists(key) for key in keys]
+
+    def confirmMany(self, keys):
+        '''
+        Like existsMany, but asks the backend itself rather than any index of it, for when
+        the files are about to be used by path and a stale answer would break something
+        '''
+        return self.existsMany(keys)
+
+    def get(self, key):
+        '''
+        Returns the bytes stored at key, or None if there is nothing there
+        '''
+        raise NotImplementedError()
+
+    def put(self, key, data):
+        '''
+        Stores data at key atomically, readers see either nothing or all of it
+        '''
+        raise NotImplementedError()
+
+    def delete(self, key):
+        '''
+        Removes key, if it is there
+        '''
+        raise NotImplementedError()
+
+    def scan(self, prefix):
+        '''
+        Lazily yields (key, size, mtime) for every key under the dir prefix, in no particular order
+        '''
+        raise NotImplementedError()
+
+    def stream(self, key, chunkSize=1024 * 1024):
+        '''
+        Yields the bytes stored at key in chunks, for sending large files
+        '''
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        for i in range(0, len(data), chunkSize):
+            yield data[i : i + chunkSize]
+
+    def localPath(self, key):
+        '''
+        Returns a path on the local filesystem key can be read from directly, if the backend has one
+        '''
+        return None
+
+    @contextlib.contextmanager
+    def localFiles(self, keys):
+        '''
+        Yields local file paths for keys, for tools like ffmpeg which need real files.
+        Backends without local paths download them into a temp dir that is removed afterwards,
+        raising FileNotFoundError if a key is gone, eg. collected since it was checked
+        '''
+        paths = [self.localPath(key) for key in keys]
+        if all(paths):
+            for key, path in zip(keys, paths):
+                if not os.path.isfile(path):
+                    raise FileNotFoundError(f"{key} is not in storage")
+            yield paths
+            return
+        tmpdir = tempfile.mkdtemp(prefix="checkface-")
+        try:
+            localPaths = {}
+            for key in keys:
+                if key not in localPaths:
+                    data = self.get(key)
+                    if data is None:
+                        raise FileNotFoundError(f"{key} is not in storage")
+                    localPaths[key] = os.path.join(tmpdir, f"{len(localPaths):04d}-{os.path.basename(key)}")
+                    with open(localPaths[key], 'wb') as f:
+                        f.write(data)
+            yield [localPaths[key] for key in keys]
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class LocalStorage(Storage):
+    '''
+    Files in a directory on the local filesystem, the original checkfacedata layout
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        name = self.path(key)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        # write to a temp file in the same dir and rename it over name,
+        # so concurrent readers never see a partially written file
+        fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(name), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp makes it 0600, and os.fchmod doesn't exist on windows
+            os.chmod(tmpName, 0o644)
+            os.replace(tmpName, name)
+        except:
+            if os.path.exists(tmpName):
+                os.unlink(tmpName)
+            raise
+
+    def delete(self, key):
+        name = self.path(key)
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            return
+        # remove dirs left empty, so deleted morph frames don't leave thousands of them behind
+        dirName = os.path.dirname(name)
+        while dirName != self.root and dirName.startswith(self.root):
+            try:
+                os.rmdir(dirName)
+            except OSError:
+                break
+            dirName = os.path.dirname(dirName)
+
+    def scan(self, prefix):
+        # scandir one dir at a time rather than walking the whole tree up front
+        dirs = [prefix]
+        while dirs:
+            dirKey = dirs.pop()
+            try:
+                entries = list(os.scandir(self.path(dirKey)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                key = f"{dirKey}/{entry.name}"
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(key)
+                elif not entry.name.startswith(".tmp-"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield key, stat.st_size, stat.st_mtime
+
+    def stream(self, key, chunkSize=1024 * 1024):
+        with open(self.path(key), 'rb') as f:
+            while True:
+                chunk = f.read(chunkSize)
+                if not chunk:
+                    break
+                yield chunk
+
+    def localPath(self, key):
+        return self.path(key)
+
+
+class TieredStorage(Storage):
+    '''
+    A small fast store (eg. local SSD) in front of a big slow one (eg. NFS or S3).
+    Writes go to both, reads are promoted into the fast tier on first use
+    '''
+
+    def __init__(self, fast: Storage, slow: Storage):
+        self.fast = fast
+        self.slow = slow
+
+    def exists(self, key):
+        return self.fast.exists(key) or self.slow.exists(key)
+
+    def existsMany(self, keys):
+        found = self.fast.existsMany(keys)
+        missingKeys = [key for key, isFound in zip(keys, found) if not isFound]
+        if not missingKeys:
+            return found
+        slowFound = iter(self.slow.existsMany(missingKeys))
+        return [isFound or next(slowFound) for isFound in found]
+
+    def get(self, key):
+        data = self.fast.get(key)
+        if data is None:
+            data = self.slow.get(key)
+            if data is not None:
+                self.fast.put(key, data)
+        return data
+
+    def put(self, key, data):
+        self.slow.put(key, data)
+        self.fast.put(key, data)
+
+    def delete(self, key):
+        self.fast.delete(key)
+        self.slow.delete(key)
+
+    def scan(self, prefix):
+        # everything in the fast tier was also written to the slow one
+        return self.slow.scan(prefix)
+
+    def stream(self, key, chunkSize=1024 * 1024):
+        if not self.fast.exists(key):
+            self.get(key) # promote
+        return self.fast.stream(key, chunkSize)
+
+    def localPath(self, key):
+        if not self.fast.exists(key):
+            self.get(key) # promote
+        return self.fast.localPath(key)
+
+
+class S3Storage(Storage):
+    '''
+    Objects in an S3 compatible bucket, eg. AWS S3 or MinIO, so replicas can share generated images.
+    Needs boto3, which reads credentials from the usual AWS_* environment variables
+    '''
+
+    def __init__(self, bucket, prefix="", endpointUrl=None, maxWorkers=16):
+        import boto3 # only needed for this backend
+        self.s3 = boto3.client('s3', endpoint_url=endpointUrl)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+
+    def objectKey(self, key):
+        return self.prefix + key
+
+    def exists(self, key):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.objectKey(key))
+            return True
+        except self.s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def existsMany(self, keys):
+        return list(self.pool.map(self.exists, keys))
+
+    def get(self, key):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.objectKey(key))['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    def put(self, key, data):
+        self.s3.put_object(Bucket=self.bucket, Key=self.objectKey(key), Body=data)
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.objectKey(key))
+
+    def scan(self, prefix):
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.objectKey(prefix + "/")):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):], obj['Size'], obj['LastModified'].timestamp()
+
+    def stream(self, key, chunkSize=1024 * 1024):
+        body = self.s3.get_object(Bucket=self.bucket, Key=self.objectKey(key))['Body']
+        return body.iter_chunks(chunkSize)
+
+
+class IndexedStorage(Storage):
+    '''
+    Keeps the keys of another storage in memory, so deciding whether something
+    has already been generated costs no syscalls or round trips.
+
+    The index is filled by a scan of prefixes in a background thread, and kept
+    up to date by puts and deletes made through this object. Until the first scan
+    finishes, keys not in it yet are looked up in the wrapped storage. After that,
+    rescanSeconds (if set) rescans to pick up changes made by other processes.
+
+    With bloomCapacity set, a Bloom filter sized for that many keys is kept instead
+    of a set, using about 1% of the memory: lookups of keys that don't exist still
+    cost nothing, and keys that probably exist are confirmed in the wrapped storage
+    '''
+
+    def __init__(self, storage: Storage, prefixes, bloomCapacity=None, rescanSeconds=None):
+        self.storage = storage
+        self.prefixes = tuple(prefix + "/" for prefix in prefixes)
+        self.bloomCapacity = bloomCapacity
+        self.rescanSeconds = rescanSeconds
+        self.lock = threading.Lock()
+        self.keys = self._newIndex()
+        self.scanKeys = None
+        self.deletedDuringScan = set()
+        self.complete = False
+        threading.Thread(target=self._scanLoop, daemon=True).start()
+
+    def _newIndex(self):
+        return set() if self.bloomCapacity is None else BloomFilter(self.bloomCapacity)
+
+    def _scanLoop(self):
+        while True:
+            found = self._newIndex()
+            with self.lock:
+                self.scanKeys = found
+                self.deletedDuringScan = set()
+            try:
+                for prefix in self.prefixes:
+                    for key, _, _ in self.storage.scan(prefix[:-1]):
+                        found.add(key)
+            except Exception:
+                logger.exception("Storage index scan failed")
+                with self.lock:
+                    self.scanKeys = None
+                return
+            with self.lock:
+                if self.bloomCapacity is None:
+                    # the scan may have seen these before they were deleted
+                    found.difference_update(self.deletedDuringScan)
+                self.keys = found
+                self.scanKeys = None
+                self.complete = True
+            if not self.rescanSeconds:
+                return
+            time.sleep(self.rescanSeconds)
+
+    def _lookup(self, key):
+        '''
+        Returns True or False when the index knows, None when the wrapped storage has to be asked
+        '''
+        if key in self.keys:
+            return True if self.bloomCapacity is None else None
+        if self.complete and key.startswith(self.prefixes):
+            return False
+        return None
+
+    def exists(self, key):
+        known = self._lookup(key)
+        return self.storage.exists(key) if known is None else known
+
+    def existsMany(self, keys):
+        found = [self._lookup(key) for key in keys]
+        unknownKeys = [key for key, known in zip(keys, found) if known is None]
+        if not unknownKeys:
+            return found
+        unknownFound = iter(self.storage.existsMany(unknownKeys))
+        return [next(unknownFound) if known is None else known for known in found]
+
+    def confirmMany(self, keys):
+        found = self.storage.existsMany(keys)
+        if self.bloomCapacity is None:
+            # deleted by another process, such as cachegc.py
+            with self.lock:
+                for key, exists in zip(keys, found):
+                    if not exists:
+                        self.keys.discard(key)
+        return found
+
+    def get(self, key):
+        data = self.storage.get(key)
+        if data is None and self.bloomCapacity is None:
+            # removed by another process
+            with self.lock:
+                self.keys.discard(key)
+        return data
+
+    def put(self, key, data):
+        self.storage.put(key, data)
+        with self.lock:
+            self.keys.add(key)
+            if self.scanKeys is not None:
+                self.scanKeys.add(key)
+
+    def delete(self, key):
+        self.storage.delete(key)
+        if self.bloomCapacity is None:
+            with self.lock:
+                self.keys.discard(key)
+                if self.scanKeys is not None:
+                    self.deletedDuringScan.add(key)
+                    self.scanKeys.discard(key)
+
+    def scan(self, prefix):
+        return self.storage.scan(prefix)
+
+    def stream(self, key, chunkSize=1024 * 1024):
+        return self.storage.stream(key, chunkSize)
+
+    def localPath(self, key):
+        return self.storage.localPath(key)
+
+    def localFiles(self, keys):
+        return self.storage.localFiles(keys)
+
+
+def storageFromEnv(defaultRoot):
+    '''
+    Builds the storage backend selected by the CHECKFACE_STORAGE environment variable
+    '''
+    kind = os.getenv('CHECKFACE_STORAGE', 'local').lower()
+
+    def s3FromEnv():
+        return S3Storage(os.environ['S3_BUCKET'], os.getenv('S3_PREFIX', ''), os.getenv('S3_ENDPOINT_URL'))
+
+    if kind == 'local':
+        return LocalStorage(os.getenv('STORAGE_DIR', defaultRoot))
+    if kind == 's3':
+        return s3FromEnv()
+    if kind == 'pack':
+        from packstore import PackStorage # imports this module
+        return PackStorage(os.getenv('STORAGE_DIR', os.path.join(defaultRoot, "packs")),
+                           segmentBytes=int(os.getenv('PACK_SEGMENT_MB', '256')) * 1024 * 1024)
+    if kind == 'tiered':
+        fast = LocalStorage(os.environ['STORAGE_FAST_DIR'])
+        if os.getenv('S3_BUCKET'):
+            slow = s3FromEnv()
+        else:
+            slow = LocalStorage(os.getenv('STORAGE_SLOW_DIR', defaultRoot))
+        return TieredStorage(fast, slow)
+    raise ValueError(f"Unknown CHECKFACE_STORAGE \"{kind}\", must be local, pack, tiered or s3")
+
+
+def indexFromEnv(storage, prefixes):
+    '''
+    Wraps storage in an IndexedStorage of the keys under prefixes, as selected by the STORAGE_INDEX environment variable
+    '''
+    # the pack store already has its index in memory, and remote stores may be shared with other replicas
+    kind = os.getenv('STORAGE_INDEX', 'set' if isinstance(storage, LocalStorage) else 'off').lower()
+    rescanSeconds = float(os.getenv('STORAGE_INDEX_RESCAN_SECONDS', '0'))
+    if kind == 'off':
+        return storage
+    if kind == 'set':
+        return IndexedStorage(storage, prefixes, rescanSeconds=rescanSeconds)
+    if kind == 'bloom':
+        return IndexedStorage(storage, prefixes, bloomCapacity=int(os.getenv('STORAGE_INDEX_BLOOM_KEYS', '10000000')),
+                              rescanSeconds=rescanSeconds)
+    raise ValueError(f"Unknown STORAGE_INDEX \"{kind}\", must be set, bloom or off")
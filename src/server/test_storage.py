@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import LocalStorage, TieredStorage
+from packstore import PackStorage
+
+# Round trips through each storage backend, run with python -m unittest test_storage (or pytest) from src/server
+
+
+class StorageTests:
+    '''
+    The behaviour every backend shares, mixed into a TestCase per backend
+    '''
+
+    def makeStorage(self, root):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="checkface-test-")
+        self.storage = self.makeStorage(self.root)
+
+    def tearDown(self):
+        close = getattr(self.storage, 'close', None)
+        if close is not None:
+            close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_put_get(self):
+        self.storage.put("outputImages/ab/face_300.jpg", b"jpeg bytes")
+        self.assertEqual(self.storage.get("outputImages/ab/face_300.jpg"), b"jpeg bytes")
+
+    def test_get_missing(self):
+        self.assertIsNone(self.storage.get("outputImages/ab/missing.jpg"))
+
+    def test_put_overwrites(self):
+        self.storage.put("outputImages/ab/face.jpg", b"old")
+        self.storage.put("outputImages/ab/face.jpg", b"new")
+        self.assertEqual(self.storage.get("outputImages/ab/face.jpg"), b"new")
+
+    def test_empty_file(self):
+        self.storage.put("outputImages/ab/empty.jpg", b"")
+        self.assertTrue(self.storage.exists("outputImages/ab/empty.jpg"))
+        self.assertEqual(self.storage.get("outputImages/ab/empty.jpg"), b"")
+
+    def test_exists(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        self.assertTrue(self.storage.exists("outputImages/ab/a.jpg"))
+        self.assertFalse(self.storage.exists("outputImages/ab/b.jpg"))
+        self.assertEqual(self.storage.existsMany(["outputImages/ab/a.jpg", "outputImages/ab/b.jpg"]), [True, False])
+        self.assertEqual(self.storage.confirmMany(["outputImages/ab/a.jpg", "outputImages/ab/b.jpg"]), [True, False])
+
+    def test_delete(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        self.storage.delete("outputImages/ab/a.jpg")
+        self.assertFalse(self.storage.exists("outputImages/ab/a.jpg"))
+        self.assertIsNone(self.storage.get("outputImages/ab/a.jpg"))
+        # deleting what isn't there is fine
+        self.storage.delete("outputImages/ab/a.jpg")
+
+    def test_scan(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        self.storage.put("outputImages/cd/b.jpg", b"bb")
+        self.storage.put("morphs/c.mp4", b"ccc")
+        sizes = {key: size for key, size, _ in self.storage.scan("outputImages")}
+        self.assertEqual(sizes, {"outputImages/ab/a.jpg": 1, "outputImages/cd/b.jpg": 2})
+
+    def test_stream(self):
+        self.storage.put("morphs/a.mp4", b"0123456789")
+        self.assertEqual(b"".join(self.storage.stream("morphs/a.mp4", chunkSize=3)), b"0123456789")
+
+    def test_local_files(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        self.storage.put("outputImages/ab/b.jpg", b"b")
+        with self.storage.localFiles(["outputImages/ab/a.jpg", "outputImages/ab/b.jpg", "outputImages/ab/a.jpg"]) as paths:
+            contents = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    contents.append(f.read())
+        self.assertEqual(contents, [b"a", b"b", b"a"])
+
+    def test_local_files_missing(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        with self.assertRaises(FileNotFoundError):
+            with self.storage.localFiles(["outputImages/ab/a.jpg", "outputImages/ab/missing.jpg"]):
+                pass
+
+
+class LocalStorageTests(StorageTests, unittest.TestCase):
+    def makeStorage(self, root):
+        return LocalStorage(root)
+
+    def test_delete_removes_empty_dirs(self):
+        self.storage.put("outputImages/ab/cd/a.jpg", b"a")
+        self.storage.delete("outputImages/ab/cd/a.jpg")
+        self.assertEqual(list(self.storage.scan("outputImages")), [])
+        self.assertFalse(os.path.exists(self.storage.path("outputImages/ab")))
+
+
+class PackStorageTests(StorageTests, unittest.TestCase):
+    def makeStorage(self, root):
+        return PackStorage(root, segmentBytes=64, compactIntervalSeconds=0)
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = self.makeStorage(self.root)
+
+    def test_reopen(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a" * 40)
+        self.storage.put("outputImages/ab/b.jpg", b"b" * 40)
+        self.storage.put("outputImages/ab/a.jpg", b"new")
+        self.storage.delete("outputImages/ab/b.jpg")
+        self.reopen()
+        self.assertEqual(self.storage.get("outputImages/ab/a.jpg"), b"new")
+        self.assertFalse(self.storage.exists("outputImages/ab/b.jpg"))
+
+    def test_compact(self):
+        for i in range(10):
+            self.storage.put(f"outputImages/ab/{i}.jpg", bytes([i]) * 40)
+        for i in range(8):
+            self.storage.delete(f"outputImages/ab/{i}.jpg")
+        self.assertGreater(self.storage.compact(), 0)
+        self.reopen()
+        self.assertEqual([self.storage.exists(f"outputImages/ab/{i}.jpg") for i in range(10)], [False] * 8 + [True] * 2)
+        self.assertEqual(self.storage.get("outputImages/ab/9.jpg"), bytes([9]) * 40)
+
+
+class TieredStorageTests(StorageTests, unittest.TestCase):
+    def makeStorage(self, root):
+        self.fast = LocalStorage(f"{root}/fast")
+        self.slow = LocalStorage(f"{root}/slow")
+        return TieredStorage(self.fast, self.slow)
+
+    def test_put_writes_both(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        self.assertEqual(self.fast.get("outputImages/ab/a.jpg"), b"a")
+        self.assertEqual(self.slow.get("outputImages/ab/a.jpg"), b"a")
+
+    def test_get_promotes(self):
+        self.slow.put("outputImages/ab/a.jpg", b"a")
+        self.assertEqual(self.storage.get("outputImages/ab/a.jpg"), b"a")
+        self.assertEqual(self.fast.get("outputImages/ab/a.jpg"), b"a")
+
+    def test_delete_removes_both(self):
+        self.storage.put("outputImages/ab/a.jpg", b"a")
+        self.storage.delete("outputImages/ab/a.jpg")
+        self.assertFalse(self.fast.exists("outputImages/ab/a.jpg"))
+        self.assertFalse(self.slow.exists("outputImages/ab/a.jpg"))
+
+
+if __name__ == '__main__':
+    unittest.main()
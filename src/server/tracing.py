@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+import collections
+import contextlib
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Just enough tracing to follow a request through the job queue into the worker's batch,
+# exported as OTLP/JSON so any OpenTelemetry collector (or a file) can take it.
+# Unsampled spans are a shared no-op object, so tracing can stay on in production.
+
+
+def _nowNs():
+    # time.time_ns needs python 3.7
+    return int(time.time() * 1e9)
+
+
+class SpanContext:
+    def __init__(self, traceId, spanId, sampled):
+        self.traceId = traceId
+        self.spanId = spanId
+        self.sampled = sampled
+
+    @staticmethod
+    def fromTraceparent(header):
+        '''
+        Parses a W3C traceparent header, returns None if it isn't valid
+        '''
+        try:
+            version, traceId, spanId, flags = header.strip().split('-')
+            if len(traceId) != 32 or len(spanId) != 16 or int(traceId, 16) == 0:
+                return None
+            return SpanContext(traceId, spanId, bool(int(flags, 16) & 1))
+        except (ValueError, AttributeError):
+            return None
+
+    def toTraceparent(self):
+        return f"00-{self.traceId}-{self.spanId}-{'01' if self.sampled else '00'}"
+
+
+class Span:
+    def __init__(self, tracer, name, context: SpanContext, parentSpanId, links, attributes, startNs):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parentSpanId = parentSpanId
+        self.links = links
+        self.attributes = dict(attributes or {})
+        self.startNs = startNs
+        self.endNs = None
+        self.sampled = True
+
+    def setAttribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, endNs=None):
+        self.endNs = endNs or _nowNs()
+        self.tracer._finish(self)
+
+
+class _NoopSpan:
+    sampled = False
+
+    def __init__(self, context):
+        self.context = context
+
+    def setAttribute(self, key, value):
+        pass
+
+    def end(self, endNs=None):
+        pass
+
+# outside of any trace, spans started here begin a new one
+NOOP_SPAN = _NoopSpan(SpanContext(None, None, False))
+# in a trace that isn't sampled, so nothing under it is recorded either
+UNSAMPLED_SPAN = _NoopSpan(SpanContext('0' * 32, '0' * 16, False))
+
+
+def _otlpValue(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otlpAttributes(attributes):
+    return [{'key': key, 'value': _otlpValue(value)} for key, value in attributes.items()]
+
+
+class Tracer:
+    '''
+    Creates spans, keeps the current one per thread, and exports finished sampled spans
+    in batches from a background thread. New traces are sampled at sampleRate, child
+    spans follow their parent. exporter is called with OTLP/JSON payloads
+    '''
+
+    def __init__(self, serviceName, sampleRate=0.0, exporter=None, flushSeconds=5.0, maxQueuedSpans=10000):
+        self.serviceName = serviceName
+        self.sampleRate = sampleRate if exporter else 0.0
+        self.exporter = exporter
+        self.flushSeconds = flushSeconds
+        self.finished = collections.deque(maxlen=maxQueuedSpans) # drops the oldest if the exporter falls behind
+        self.local = threading.local()
+        # also for a sample rate of 0, requests can still arrive with a sampled traceparent
+        if self.exporter:
+            threading.Thread(target=self._flushLoop, daemon=True).start()
+
+    def currentSpan(self):
+        return getattr(self.local, 'span', NOOP_SPAN)
+
+    def setCurrentSpan(self, span):
+        '''
+        Makes span the parent of spans started on this thread, returns the previous current span
+        '''
+        previous = self.currentSpan()
+        self.local.span = span
+        return previous
+
+    def startSpan(self, name, parent=None, links=(), attributes=None, sampled=None, startNs=None):
+        '''
+        Starts a span under parent (a Span or SpanContext), or the current span if there is no parent.
+        A span without a sampled parent starts a new trace, sampled if sampled is True,
+        or by the sample rate if it is None
+        '''
+        if parent is None:
+            parent = self.currentSpan()
+        parentContext = parent if isinstance(parent, SpanContext) else parent.context
+        if parentContext.traceId is not None:
+            if not parentContext.sampled:
+                return UNSAMPLED_SPAN
+            traceId, parentSpanId = parentContext.traceId, parentContext.spanId
+        else:
+            if sampled is None:
+                sampled = self.sampleRate > 0 and random.random() < self.sampleRate
+            if not sampled:
+                return UNSAMPLED_SPAN
+            traceId, parentSpanId = f"{random.getrandbits(128):032x}", None
+        context = SpanContext(traceId, f"{random.getrandbits(64):016x}", True)
+        links = [link for link in links if link.sampled]
+        return Span(self, name, context, parentSpanId, links, attributes, startNs or _nowNs())
+
+    @contextlib.contextmanager
+    def span(self, name, **kwargs):
+        '''
+        A span around the with block, current while it runs
+        '''
+        span = self.startSpan(name, **kwargs)
+        previous = self.setCurrentSpan(span)
+        try:
+            yield span
+        finally:
+            self.setCurrentSpan(previous)
+            span.end()
+
+    def _finish(self, span):
+        if self.exporter:
+            self.finished.append(span)
+
+    def _flushLoop(self):
+        while True:
+            time.sleep(self.flushSeconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Exporting traces failed")
+
+    def flush(self):
+        spans = []
+        while self.finished:
+            spans.append(self.finished.popleft())
+        if spans:
+            self.exporter(self.toOtlp(spans))
+
+    def toOtlp(self, spans):
+        return {'resourceSpans': [{
+            'resource': {'attributes': _otlpAttributes({'service.name': self.serviceName})},
+            'scopeSpans': [{
+                'scope': {'name': self.serviceName},
+                'spans': [{
+                    'traceId': span.context.traceId,
+                    'spanId': span.context.spanId,
+                    'parentSpanId': span.parentSpanId or '',
+                    'name': span.name,
+                    'kind': 1, # internal
+                    'startTimeUnixNano': str(span.startNs),
+                    'endTimeUnixNano': str(span.endNs),
+                    'attributes': _otlpAttributes(span.attributes),
+                    'links': [{'traceId': link.traceId, 'spanId': link.spanId} for link in span.links],
+                } for span in spans],
+            }],
+        }]}
+
+
+def fileExporter(path):
+    '''
+    Appends one OTLP/JSON export request per line, the format of the collector's file exporter
+    '''
+    def export(payload):
+        with open(path, 'a') as f:
+            f.write(json.dumps(payload) + '\n')
+    return export
+
+def httpExporter(url):
+    '''
+    Posts OTLP/JSON to a collector, eg. http://localhost:4318/v1/traces
+    '''
+    def export(payload):
+        requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'}, timeout=10).raise_for_status()
+    return export
+
+def tracerFromEnv(serviceName):
+    '''
+    Builds a Tracer from the TRACE_SAMPLE_RATE, TRACE_OTLP_ENDPOINT and TRACE_FILE environment variables
+    '''
+    exporter = None
+    if os.getenv('TRACE_OTLP_ENDPOINT'):
+        exporter = httpExporter(os.getenv('TRACE_OTLP_ENDPOINT'))
+    elif os.getenv('TRACE_FILE'):
+        exporter = fileExporter(os.getenv('TRACE_FILE'))
+    return Tracer(serviceName, float(os.getenv('TRACE_SAMPLE_RATE', '0')), exporter)